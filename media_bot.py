@@ -2,18 +2,27 @@ import logging
 import os
 import re
 import shutil
-import glob
+import sys
 import asyncio
-import json
-import itertools
+import functools
 import traceback
-import tempfile
+import io
+import json
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+import threading
 import time
 from datetime import datetime
-from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-import requests
-from telegram.error import NetworkError, TimedOut, RetryAfter
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from urllib.parse import urlsplit
+from telegram import InputFile, Update
+from telegram.ext import AIORateLimiter, Application, CommandHandler, MessageHandler, filters, ContextTypes
+import httpx
+from telegram.error import Forbidden, NetworkError, TimedOut, RetryAfter, TelegramError
+from yt_dlp import YoutubeDL
+from yt_dlp.utils import DownloadCancelled, DownloadError, YoutubeDLError
 from mp3_downloader import MP3Downloader
 
 # --- НАСТРОЙКА ЛОГИРОВАНИЯ (УБИРАЕМ СПАМ) ---
@@ -21,11 +30,11 @@ logging.getLogger('httpx').setLevel(logging.ERROR)
 logging.getLogger('httpcore').setLevel(logging.ERROR)
 logging.getLogger('telegram').setLevel(logging.WARNING)
 
-# Основная настройка логирования
+# Основная настройка логирования (LOG_LEVEL=WARNING убирает подробный лог каждой загрузки)
 logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(message)s",
     datefmt="%d.%m.%Y %H:%M:%S",
-    level=logging.INFO
+    level=os.getenv("LOG_LEVEL", "INFO").upper()
 )
 
 # --- КОНФИГУРАЦИЯ ---
@@ -33,21 +42,51 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 GROUP_IDS_STR = os.getenv("ALLOWED_GROUP_IDS")
 ADMIN_GROUP_ID = os.getenv("ADMIN_GROUP_ID")
 TEMP_DOWNLOADS_DIR = "/app/bot_temp"
+# Кэш yt-dlp (подписи и nsig плеера YouTube) живет между запросами, чтобы не разбирать плеер заново
+YTDLP_CACHE_DIR = os.path.join(TEMP_DOWNLOADS_DIR, "ytdlp_cache")
 COOKIES_DIR = "/app/cookies"
+# Паузы cookie хранятся отдельно от папки cookie: запись не меняет ее mtime (и не вызывает пересканирование),
+# а папку cookie можно монтировать только для чтения
+COOKIE_STATE_DIR = os.path.join(TEMP_DOWNLOADS_DIR, "cookie_state")
 TELEGRAM_SIZE_LIMIT_BYTES = 49 * 1024 * 1024 # 49 МБ для надежности
+SUBPROCESS_STDERR_TAIL_LINES = 200 # Сколько последних строк STDERR подпроцесса хранить
+ERROR_REPORT_STDERR_MAX_CHARS = 32 * 1024 # Сколько последних символов STDERR yt-dlp попадает в отчет админу
 TELEGRAM_CONNECT_TIMEOUT_SECONDS = int(os.getenv("TELEGRAM_CONNECT_TIMEOUT_SECONDS", "30"))
 TELEGRAM_READ_TIMEOUT_SECONDS = int(os.getenv("TELEGRAM_READ_TIMEOUT_SECONDS", "180"))
 TELEGRAM_WRITE_TIMEOUT_SECONDS = int(os.getenv("TELEGRAM_WRITE_TIMEOUT_SECONDS", "180"))
 TELEGRAM_POOL_TIMEOUT_SECONDS = int(os.getenv("TELEGRAM_POOL_TIMEOUT_SECONDS", "30"))
+TELEGRAM_CONNECTION_POOL_SIZE = int(os.getenv("TELEGRAM_CONNECTION_POOL_SIZE", "64"))
+TELEGRAM_HTTP_VERSION = os.getenv("TELEGRAM_HTTP_VERSION", "2")
+TELEGRAM_RATE_LIMIT_RETRIES = int(os.getenv("TELEGRAM_RATE_LIMIT_RETRIES", "1"))
+# Лимит запросов в одну группу для AIORateLimiter. Он считает все вызовы в чат (статус, его правки, удаление,
+# отправка видео - 4-6 на ссылку), а не только новые сообщения, поэтому 20/мин по умолчанию из PTB
+# тормозил бы правки статуса уже на 4-5 ссылках в минуту. 0 отключает лимит по группам
+TELEGRAM_GROUP_MAX_RATE = float(os.getenv("TELEGRAM_GROUP_MAX_RATE", "60"))
+TELEGRAM_GROUP_TIME_PERIOD_SECONDS = float(os.getenv("TELEGRAM_GROUP_TIME_PERIOD_SECONDS", "60"))
 TELEGRAM_SEND_VIDEO_ATTEMPTS = int(os.getenv("TELEGRAM_SEND_VIDEO_ATTEMPTS", "4"))
 TELEGRAM_SEND_VIDEO_RETRY_DELAY_SECONDS = int(os.getenv("TELEGRAM_SEND_VIDEO_RETRY_DELAY_SECONDS", "10"))
+STATUS_UPDATE_DELAY_SECONDS = float(os.getenv("STATUS_UPDATE_DELAY_SECONDS", "0.5"))
+ADMIN_REPORT_TIMEOUT_SECONDS = int(os.getenv("ADMIN_REPORT_TIMEOUT_SECONDS", "20"))
+COOKIE_PARALLEL_ATTEMPTS = int(os.getenv("COOKIE_PARALLEL_ATTEMPTS", "3"))
+COOKIE_COOLDOWN_SECONDS = int(os.getenv("COOKIE_COOLDOWN_SECONDS", "600"))
+SENT_VIDEO_CACHE_SIZE = int(os.getenv("SENT_VIDEO_CACHE_SIZE", "512"))
+SENT_VIDEO_CACHE_TTL_SECONDS = int(os.getenv("SENT_VIDEO_CACHE_TTL_SECONDS", "1800"))
 YTDLP_SOCKET_TIMEOUT_SECONDS = int(os.getenv("YTDLP_SOCKET_TIMEOUT_SECONDS", "60"))
 YTDLP_RETRIES = int(os.getenv("YTDLP_RETRIES", "10"))
 YTDLP_FRAGMENT_RETRIES = int(os.getenv("YTDLP_FRAGMENT_RETRIES", "10"))
+# Сколько обработчик ждет проверку (info без скачивания). По истечении он получает TimeoutError и освобождает
+# слот чата; сам поток yt-dlp прервать нельзя, он завершается по socket_timeout/retries и до этого
+# занимает место в YTDLP_CONCURRENCY
+YTDLP_PROBE_TIMEOUT_SECONDS = int(os.getenv("YTDLP_PROBE_TIMEOUT_SECONDS", "30"))
+CHAT_DOWNLOAD_CONCURRENCY = int(os.getenv("CHAT_DOWNLOAD_CONCURRENCY", "2"))
+YTDLP_CONCURRENCY = int(os.getenv("YTDLP_CONCURRENCY", str(os.cpu_count() or 2)))
+SUBPROCESS_CONCURRENCY = int(os.getenv("SUBPROCESS_CONCURRENCY", str(os.cpu_count() or 2)))
+YOUTUBE_PARALLEL_FORMATS = int(os.getenv("YOUTUBE_PARALLEL_FORMATS", "3"))
+TEMP_FOLDER_POOL_SIZE = int(os.getenv("TEMP_FOLDER_POOL_SIZE", str((os.cpu_count() or 2) * 4)))
 
 if not BOT_TOKEN or not GROUP_IDS_STR:
     logging.critical("ERROR: BOT_TOKEN, ALLOWED_GROUP_IDS environment variables not set!")
-    exit()
+    sys.exit(1)
 
 # ADMIN_GROUP_ID не обязательный, но если задан, то должен быть числом
 if ADMIN_GROUP_ID:
@@ -56,38 +95,64 @@ if ADMIN_GROUP_ID:
         logging.info(f"Admin group ID set: {ADMIN_GROUP_ID}")
     except ValueError:
         logging.critical("ERROR: ADMIN_GROUP_ID must be a valid integer!")
-        exit()
+        sys.exit(1)
 else:
     logging.info("ADMIN_GROUP_ID not set - error notifications disabled")
 
-try:
-    ALLOWED_GROUP_IDS = {int(group_id.strip()) for group_id in GROUP_IDS_STR.split(',')}
-except (ValueError, TypeError):
-    logging.critical(f"ERROR: Invalid format in ALLOWED_GROUP_IDS.")
-    exit()
+def parse_group_ids(group_ids_str: str):
+    """Разбирает ALLOWED_GROUP_IDS по одному ID, пропуская пустые и некорректные значения"""
+    for token in group_ids_str.split(','):
+        token = token.strip()
+        if not token:
+            continue
+        try:
+            yield int(token)
+        except ValueError:
+            logging.warning("Skipping invalid group ID in ALLOWED_GROUP_IDS: %r", token)
+
+ALLOWED_GROUP_IDS = frozenset(parse_group_ids(GROUP_IDS_STR))
+if not ALLOWED_GROUP_IDS:
+    logging.critical("ERROR: Invalid format in ALLOWED_GROUP_IDS.")
+    sys.exit(1)
 
 if not os.path.exists(TEMP_DOWNLOADS_DIR):
     try: os.makedirs(TEMP_DOWNLOADS_DIR)
-    except OSError as e: logging.critical(f"Failed to create directory {TEMP_DOWNLOADS_DIR}: {e}"); exit()
+    except OSError as e: logging.critical(f"Failed to create directory {TEMP_DOWNLOADS_DIR}: {e}"); sys.exit(1)
 
 logger = logging.getLogger(__name__)
 script_dir = os.path.dirname(os.path.abspath(__file__))
 
-# Инициализируем MP3 downloader
-mp3_downloader = MP3Downloader(TEMP_DOWNLOADS_DIR, TELEGRAM_SIZE_LIMIT_BYTES)
-
-# Глобальная переменная для передачи контекста в CookieRotator
-_current_bot_context = None
-# Глобальная переменная для хранения последнего STDERR от yt-dlp
-_last_ytdlp_stderr = ""
-_last_video_send_debug = ""
-
-def get_ytdlp_network_options() -> list[str]:
-    return [
-        '--socket-timeout', str(YTDLP_SOCKET_TIMEOUT_SECONDS),
-        '--retries', str(YTDLP_RETRIES),
-        '--fragment-retries', str(YTDLP_FRAGMENT_RETRIES),
-    ]
+# Контекст бота для CookieRotator (отчеты админу). ContextVar, а не глобальная переменная:
+# у каждой обрабатываемой ссылки (asyncio-задачи) свое значение
+_current_bot_context: ContextVar[ContextTypes.DEFAULT_TYPE | None] = ContextVar('current_bot_context', default=None)
+# Отладочные данные для отчетов админу: последний STDERR yt-dlp и попытки send_video.
+# Каждый обработчик (ссылка, /downloadmp3) ставит свой словарь, поэтому параллельные запросы не перезаписывают
+# данные друг друга, а запущенные им задачи (попытки с cookie) пишут в тот же словарь.
+# Вне обработчиков словаря нет (None): общего словаря по умолчанию быть не должно
+_report_debug: ContextVar[dict | None] = ContextVar('report_debug', default=None)
+# Выставляется, если бота удалили из админ-группы: дальнейшие отчеты не отправляем
+_admin_group_unavailable = False
+# Ограничение числа одновременных загрузок yt-dlp (каждая может занимать сотни МБ и ffmpeg)
+_ytdlp_semaphore = asyncio.Semaphore(YTDLP_CONCURRENCY)
+# Свои потоки для yt-dlp: долгие загрузки не занимают общий пул asyncio.to_thread (open, stat, очистка папок)
+_ytdlp_executor = ThreadPoolExecutor(max_workers=YTDLP_CONCURRENCY, thread_name_prefix='yt-dlp')
+# То же для внешних процессов (ffprobe): при всплеске запросов лишние ждут в очереди
+_subprocess_semaphore = asyncio.Semaphore(SUBPROCESS_CONCURRENCY)
+
+# Заголовки запросов yt-dlp к платформам (собираются один раз)
+INSTAGRAM_HTTP_HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36 Edg/138.0.0.0'}
+TIKTOK_HTTP_HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36'}
+YOUTUBE_HTTP_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36 Edg/138.0.0.0',
+    'Referer': 'https://www.youtube.com/',
+}
+
+def get_ytdlp_network_options() -> dict:
+    return {
+        'socket_timeout': YTDLP_SOCKET_TIMEOUT_SECONDS,
+        'retries': YTDLP_RETRIES,
+        'fragment_retries': YTDLP_FRAGMENT_RETRIES,
+    }
 
 def format_file_debug_info(file_path: str | None) -> str:
     if not file_path:
@@ -113,7 +178,7 @@ def format_video_send_debug(
     chat_id: int,
     message_id: int,
     user,
-    video_path: str,
+    file_info: str,
     width: int | None,
     height: int | None,
     duration: int | None,
@@ -133,7 +198,7 @@ def format_video_send_debug(
         f"Video metadata: width={width}, height={height}, duration={duration}",
         f"Configured attempts: {TELEGRAM_SEND_VIDEO_ATTEMPTS}",
         f"Timeouts: connect={TELEGRAM_CONNECT_TIMEOUT_SECONDS}s, read={TELEGRAM_READ_TIMEOUT_SECONDS}s, write={TELEGRAM_WRITE_TIMEOUT_SECONDS}s, pool={TELEGRAM_POOL_TIMEOUT_SECONDS}s",
-        format_file_debug_info(video_path),
+        file_info,
         "",
         "Attempts:",
     ]
@@ -156,23 +221,28 @@ async def send_video_with_retries(
     user,
     message_id: int,
 ):
-    global _last_video_send_debug
-
+    report_debug = _report_debug.get() or {}
     attempts_log = []
     last_error = None
 
     for attempt in range(1, TELEGRAM_SEND_VIDEO_ATTEMPTS + 1):
+        # stat файла для лога и отчета - в потоке, не в event loop
+        file_info = await asyncio.to_thread(format_file_debug_info, video_path)
         started_at = time.monotonic()
-        logger.info(
-            f"Sending {platform} video to Telegram attempt {attempt}/{TELEGRAM_SEND_VIDEO_ATTEMPTS}. "
-            f"{format_file_debug_info(video_path).replace(chr(10), '; ')}"
-        )
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(
+                "Sending %s video to Telegram attempt %d/%d. %s",
+                platform, attempt, TELEGRAM_SEND_VIDEO_ATTEMPTS,
+                file_info.replace("\n", "; ")
+            )
 
         try:
-            with open(video_path, 'rb') as vf:
+            with await asyncio.to_thread(open, video_path, 'rb') as vf:
                 result = await context.bot.send_video(
                     chat_id=chat_id,
-                    video=vf,
+                    # read_file_handle=False: файл читается с диска частями во время загрузки,
+                    # а не целиком в память (до 50 МБ на каждую отправку)
+                    video=InputFile(vf, filename=os.path.basename(video_path), read_file_handle=False),
                     caption=caption,
                     parse_mode=parse_mode,
                     width=width,
@@ -187,11 +257,11 @@ async def send_video_with_retries(
 
             elapsed = time.monotonic() - started_at
             attempts_log.append(f"Attempt {attempt}: success in {elapsed:.1f}s")
-            _last_video_send_debug = format_video_send_debug(
+            report_debug['video_send'] = format_video_send_debug(
                 platform, source_url, chat_id, message_id, user,
-                video_path, width, height, duration, attempts_log
+                file_info, width, height, duration, attempts_log
             )
-            logger.info(f"Telegram send_video succeeded on attempt {attempt} in {elapsed:.1f}s")
+            logger.info("Telegram send_video succeeded on attempt %d in %.1fs", attempt, elapsed)
             return result
 
         except RetryAfter as e:
@@ -213,32 +283,50 @@ async def send_video_with_retries(
             attempts_log.append(
                 f"Attempt {attempt}: non-retryable {type(e).__name__} after {elapsed:.1f}s; error={e}"
             )
-            _last_video_send_debug = format_video_send_debug(
+            report_debug['video_send'] = format_video_send_debug(
                 platform, source_url, chat_id, message_id, user,
-                video_path, width, height, duration, attempts_log
+                file_info, width, height, duration, attempts_log
             )
             raise
 
-        _last_video_send_debug = format_video_send_debug(
+        report_debug['video_send'] = format_video_send_debug(
             platform, source_url, chat_id, message_id, user,
-            video_path, width, height, duration, attempts_log
+            file_info, width, height, duration, attempts_log
         )
 
         if attempt < TELEGRAM_SEND_VIDEO_ATTEMPTS:
             logger.warning(
-                f"Telegram send_video failed on attempt {attempt}/{TELEGRAM_SEND_VIDEO_ATTEMPTS}; "
-                f"retrying in {retry_delay}s: {type(last_error).__name__}: {last_error}"
+                "Telegram send_video failed on attempt %d/%d; retrying in %ds: %s: %s",
+                attempt, TELEGRAM_SEND_VIDEO_ATTEMPTS, retry_delay, type(last_error).__name__, last_error
             )
             await asyncio.sleep(retry_delay)
 
-    logger.error(f"Telegram send_video failed after {TELEGRAM_SEND_VIDEO_ATTEMPTS} attempts")
+    logger.error("Telegram send_video failed after %d attempts", TELEGRAM_SEND_VIDEO_ATTEMPTS)
     raise last_error
 
 # --- ФУНКЦИЯ ОТПРАВКИ ОШИБОК АДМИНУ ---
+def admin_reports_enabled() -> bool:
+    """Есть ли куда отправлять отчеты: без этого не тратим время на форматирование traceback"""
+    return bool(ADMIN_GROUP_ID) and not _admin_group_unavailable
+
+def build_error_details(header: str, user, chat_id: int, msg_id: int, *extra: str, exc: Exception | None = None) -> str:
+    """Текст отчета для админа; traceback форматируется только при переданном исключении"""
+    parts = [
+        header,
+        f"User: {user.username or user.first_name} (ID: {user.id})",
+        f"Chat ID: {chat_id}",
+        f"Message ID: {msg_id}",
+        *extra,
+    ]
+    if exc is not None:
+        parts += ["", f"Exception: {exc}", "", f"Traceback:\n{traceback.format_exc()}"]
+    return "\n".join(parts)
+
 async def send_error_to_admin(context: ContextTypes.DEFAULT_TYPE, error_message: str, error_details: str, platform: str = "Unknown"):
     """Отправляет сообщение об ошибке и файл с деталями в группу администратора"""
-    if not ADMIN_GROUP_ID:
-        return  # Если ID группы админа не задан, просто пропускаем
+    global _admin_group_unavailable
+    if not admin_reports_enabled():
+        return  # Если ID группы админа не задан (или недоступен), просто пропускаем
 
     try:
         # Формируем сообщение для админа
@@ -249,377 +337,819 @@ async def send_error_to_admin(context: ContextTypes.DEFAULT_TYPE, error_message:
                        f"❌ Ошибка: {error_message}\n\n" \
                        f"Подробности ошибки в прикрепленном файле."
 
-        # Создаем временный файл с деталями ошибки
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.txt', delete=False, encoding='utf-8') as tmp_file:
-            tmp_file.write(f"Отчет об ошибке бота\n")
-            tmp_file.write(f"{'='*50}\n")
-            tmp_file.write(f"Время: {timestamp}\n")
-            tmp_file.write(f"Платформа: {platform}\n")
-            tmp_file.write(f"Краткое описание: {error_message}\n")
-            tmp_file.write(f"{'='*50}\n\n")
-            tmp_file.write(f"ПОДРОБНАЯ ИНФОРМАЦИЯ ОБ ОШИБКЕ:\n")
-            tmp_file.write(f"{'-'*50}\n")
-            tmp_file.write(error_details)
+        # Собираем отчет с деталями ошибки в памяти (он небольшой, диск не нужен)
+        with io.StringIO() as report:
+            report.write(f"Отчет об ошибке бота\n")
+            report.write(f"{'='*50}\n")
+            report.write(f"Время: {timestamp}\n")
+            report.write(f"Платформа: {platform}\n")
+            report.write(f"Краткое описание: {error_message}\n")
+            report.write(f"{'='*50}\n\n")
+            report.write(f"ПОДРОБНАЯ ИНФОРМАЦИЯ ОБ ОШИБКЕ:\n")
+            report.write(f"{'-'*50}\n")
+            report.write(error_details)
 
             # Добавляем информацию из последнего STDERR yt-dlp, если есть
-            global _last_ytdlp_stderr
-            if _last_ytdlp_stderr.strip():
-                tmp_file.write(f"\n\n{'='*50}\n")
-                tmp_file.write(f"ПОСЛЕДНИЙ YT-DLP STDERR:\n")
-                tmp_file.write(f"{'-'*50}\n")
-                tmp_file.write(_last_ytdlp_stderr)
+            report_debug = _report_debug.get() or {}
+            if report_debug.get('ytdlp_stderr', '').strip():
+                report.write(f"\n\n{'='*50}\n")
+                report.write(f"ПОСЛЕДНИЙ YT-DLP STDERR:\n")
+                report.write(f"{'-'*50}\n")
+                report.write(report_debug['ytdlp_stderr'])
 
-            if _last_video_send_debug.strip():
-                tmp_file.write(f"\n\n{'='*50}\n")
-                tmp_file.write("LAST TELEGRAM VIDEO SEND DEBUG:\n")
-                tmp_file.write(f"{'-'*50}\n")
-                tmp_file.write(_last_video_send_debug)
+            if report_debug.get('video_send', '').strip():
+                report.write(f"\n\n{'='*50}\n")
+                report.write("LAST TELEGRAM VIDEO SEND DEBUG:\n")
+                report.write(f"{'-'*50}\n")
+                report.write(report_debug['video_send'])
 
-            tmp_file_path = tmp_file.name
+            report_bytes = report.getvalue().encode('utf-8')
 
         # Отправляем сообщение с файлом
-        with open(tmp_file_path, 'rb') as error_file:
-            await context.bot.send_document(
-                chat_id=ADMIN_GROUP_ID,
-                document=error_file,
-                caption=admin_message,
-                parse_mode="HTML",
-                filename=f"error_{platform}_{timestamp.replace(':', '-').replace(' ', '_')}.txt",
-                connect_timeout=TELEGRAM_CONNECT_TIMEOUT_SECONDS,
-                read_timeout=TELEGRAM_READ_TIMEOUT_SECONDS,
-                write_timeout=TELEGRAM_WRITE_TIMEOUT_SECONDS,
-                pool_timeout=TELEGRAM_POOL_TIMEOUT_SECONDS,
+        # Отчет небольшой, поэтому ограничиваем общее время отправки, чтобы медленная
+        # админ-группа не задерживала обработку ссылки (например, следующую попытку cookie)
+        with io.BytesIO(report_bytes) as error_file:
+            await asyncio.wait_for(
+                context.bot.send_document(
+                    chat_id=ADMIN_GROUP_ID,
+                    document=error_file,
+                    caption=admin_message,
+                    parse_mode="HTML",
+                    filename=f"error_{platform}_{timestamp.replace(':', '-').replace(' ', '_')}.txt",
+                    connect_timeout=ADMIN_REPORT_TIMEOUT_SECONDS,
+                    read_timeout=ADMIN_REPORT_TIMEOUT_SECONDS,
+                    write_timeout=ADMIN_REPORT_TIMEOUT_SECONDS,
+                    pool_timeout=ADMIN_REPORT_TIMEOUT_SECONDS,
+                ),
+                timeout=ADMIN_REPORT_TIMEOUT_SECONDS + 5,
             )
 
-        # Удаляем временный файл
-        os.unlink(tmp_file_path)
-
-        logger.info(f"Error report sent to admin group: {ADMIN_GROUP_ID}")
+        logger.info("Error report sent to admin group: %s", ADMIN_GROUP_ID)
 
+    except asyncio.TimeoutError:
+        logger.warning("Timed out sending error report to admin group %s", ADMIN_GROUP_ID)
+    except Forbidden as e:
+        _admin_group_unavailable = True
+        logger.error("Bot has no access to admin group %s, error reports disabled: %s", ADMIN_GROUP_ID, e)
+    except TelegramError as e:
+        logger.error("Telegram rejected error report to admin: %s: %s", type(e).__name__, e)
     except Exception as e:
-        logger.error(f"Failed to send error report to admin: {e}")
+        logger.error("Failed to send error report to admin: %s", e)
+
+# --- МЕНЕДЖЕР РОТАЦИИ COOKIE ---
+# Ошибки yt-dlp, которые означают отказ из-за cookie (лимит запросов или сессия без входа), а не проблему поста
+COOKIE_BLOCKED_RE = re.compile(
+    r"HTTP Error 429|Too Many Requests|rate[- ]limit|login required|Log in for access"
+    r"|not be comfortable for some audiences|checkpoint_required",
+    re.IGNORECASE,
+)
+
+class CookieBlockedError(Exception):
+    """Платформа отказала из-за cookie (429 или требуется вход): cookie ставится на паузу"""
+
+def raise_if_cookie_blocked(stderr: str):
+    """Поднимает CookieBlockedError, если в STDERR yt-dlp есть отказ из-за cookie"""
+    if match := COOKIE_BLOCKED_RE.search(stderr):
+        raise CookieBlockedError(f"Cookie rejected by platform: {match.group(0)}")
+
+# Кэш содержимого папки cookie: путь -> (mtime_ns, отсортированные имена файлов).
+# Общий для всех ротаторов, папка перечитывается только при изменении ее mtime.
+_cookies_dir_listing: dict[str, tuple[int, list[str]]] = {}
+
+def scan_cookies_dir(cookies_dir: str) -> tuple[int | None, list[str]]:
+    """Возвращает (mtime_ns, имена файлов) папки cookie; mtime None, если папки нет"""
+    try:
+        mtime = os.stat(cookies_dir).st_mtime_ns
+    except OSError:
+        _cookies_dir_listing.pop(cookies_dir, None)
+        return None, []
+
+    cached = _cookies_dir_listing.get(cookies_dir)
+    if cached is None or cached[0] != mtime:
+        with os.scandir(cookies_dir) as entries:
+            names = sorted(entry.name for entry in entries if entry.is_file())
+        cached = (mtime, names)
+        _cookies_dir_listing[cookies_dir] = cached
+    return cached
 
-# --- МЕНЕДЖЕР РОТАЦИИ COOKIE ДЛЯ INSTAGRAM ---
 class CookieRotator:
+    """Ротация cookie файлов Instagram (cookies*.txt)"""
+    file_prefix = 'cookies'
+    platform = 'Instagram'
+
     def __init__(self, cookies_dir: str):
         self.cookies_dir = cookies_dir
-        self.cookie_files = self._load_cookie_files()
-        self.cookie_cycle = itertools.cycle(self.cookie_files) if self.cookie_files else None
+        self.cookie_files = []
+        self.cookie_names = {}  # путь -> имя файла для логов и отчетов
+        self._idx = 0
         self.current_cookie_file = None
+        self._dir_mtime = -1
+        # Пауза для cookie после ошибки: имя файла -> время окончания (time.time(), переживает перезапуск)
+        self._cooldown_file = os.path.join(COOKIE_STATE_DIR, f"{self.file_prefix}_cooldown.json")
+        self._cooldown = self._load_cooldowns()
+        self._cooldown_lock = asyncio.Lock()
+        self.refresh_cookie_files()
+
+    def _load_cooldowns(self) -> dict[str, float]:
+        try:
+            with open(self._cooldown_file) as f:
+                cooldowns = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        now = time.time()
+        return {name: until for name, until in cooldowns.items() if until > now}
+
+    def _write_cooldowns(self, cooldowns: dict[str, float]):
+        os.makedirs(COOKIE_STATE_DIR, exist_ok=True)
+        tmp_path = f"{self._cooldown_file}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(cooldowns, f)
+        os.replace(tmp_path, self._cooldown_file)
+
+    async def save_cooldowns(self):
+        """Сохраняет паузы cookie на диск (в потоке)"""
+        async with self._cooldown_lock:
+            now = time.time()
+            self._cooldown = {name: until for name, until in self._cooldown.items() if until > now}
+            try:
+                await asyncio.to_thread(self._write_cooldowns, dict(self._cooldown))
+            except OSError as e:
+                logger.warning("⚠️ Failed to save %s cookie cooldowns: %s", self.platform.lower(), e)
 
-    def _load_cookie_files(self) -> list:
-        """Загружает все cookie файлы из директории для Instagram"""
-        if not os.path.exists(self.cookies_dir):
-            logger.warning(f"🍪 Cookies directory not found: {self.cookies_dir}")
-            return []
+    def in_cooldown(self, cookie_path: str) -> bool:
+        return self._cooldown.get(self.cookie_names.get(cookie_path), 0) > time.time()
 
-        # Ищем все файлы cookies*.txt (для Instagram)
-        files = sorted(glob.glob(os.path.join(self.cookies_dir, 'cookies*.txt')))
+    def _load_cookie_files(self, names: list[str]) -> dict[str, str]:
+        """Отбирает cookie файлы платформы из содержимого директории. Возвращает {путь: имя файла}"""
+        files = {
+            os.path.join(self.cookies_dir, name): name for name in names
+            if name.startswith(self.file_prefix) and name.endswith('.txt')
+        }
 
+        label = self.platform.lower()
         if files:
-            logger.info(f"🍪 Found {len(files)} instagram cookie files: {[os.path.basename(f) for f in files]}")
+            logger.info("🍪 Found %s %s cookie files: %s", len(files), label, list(files.values()))
         else:
-            logger.warning(f"🍪 No instagram cookie files found in {self.cookies_dir}")
+            logger.warning("🍪 No %s cookie files found in %s", label, self.cookies_dir)
 
         return files
 
-    def get_next_cookie(self) -> str:
-        """Возвращает путь к следующему cookie файлу из ротации"""
-        if not self.cookie_cycle:
-            raise Exception("No available cookie files")
-
-        self.current_cookie_file = next(self.cookie_cycle)
-        cookie_name = os.path.basename(self.current_cookie_file)
-        logger.info(f"🔄 Switching to instagram cookie: {cookie_name}")
-
-        return self.current_cookie_file
-
-    async def try_with_all_cookies_async(self, process_func, url, temp_folder, *args, **kwargs):
-        """Асинхронно пробует обработать с каждым cookie по очереди (проверка + скачивание)"""
-        if not self.cookie_files:
-            raise Exception("No available cookie files for attempts")
-
-        attempts_total = len(self.cookie_files)
-        last_error = None
-
-        for attempt in range(attempts_total):
-            try:
-                cookie_path = self.get_next_cookie()
-                cookie_name = os.path.basename(cookie_path)
-
-                logger.info(f"🍪 Attempt {attempt + 1}/{attempts_total} with instagram cookie: {cookie_name}")
-                result = await process_func(cookie_path, url, temp_folder, *args, **kwargs)
-
-                logger.info(f"✅ Successfully processed with instagram cookie: {cookie_name}")
-                return result
-
-            except Exception as e:
-                last_error = e
-                cookie_name = os.path.basename(self.current_cookie_file) if self.current_cookie_file else "unknown"
-                error_msg = str(e)
-
-                # Проверяем, является ли это ошибкой "только фото"
-                if error_msg.startswith("PHOTO_ONLY:"):
-                    logger.info(f"ℹ️ Instagram cookie {cookie_name}: Detected photo-only post")
-                    # Для фото-постов не пробуем другие cookie, сразу возвращаем ошибку
-                    raise e
-                else:
-                    logger.warning(f"❌ Error with instagram cookie {cookie_name}: {str(e)}")
-
-                    # Отправляем уведомление админу только о реальных ошибках
-                    if _current_bot_context and ADMIN_GROUP_ID:
-                        error_details = f"Instagram cookie error for URL: {url}\n"
-                        error_details += f"Cookie file: {cookie_name}\n"
-                        error_details += f"Attempt: {attempt + 1}/{attempts_total}\n"
-                        error_details += f"Cookie path: {cookie_path}\n\n"
-                        error_details += f"Exception: {str(e)}\n\n"
-                        error_details += f"Traceback:\n{traceback.format_exc()}"
-
-                        try:
-                            await send_error_to_admin(
-                                _current_bot_context,
-                                f"Instagram cookie {cookie_name}: Ошибка при попытке {attempt + 1}/{attempts_total}",
-                                error_details,
-                                "Instagram Cookie"
-                            )
-                        except Exception as admin_error:
-                            logger.error(f"Failed to send cookie error to admin: {admin_error}")
-
-                if attempt < attempts_total - 1:
-                    logger.info("🔄 Trying next instagram cookie...")
+    def refresh_cookie_files(self):
+        """Перечитывает список cookie, если содержимое папки изменилось (без перезапуска бота)"""
+        self._apply_cookies_dir(*scan_cookies_dir(self.cookies_dir))
 
-        raise Exception(f"All instagram cookie files failed. Last error: {last_error}")
+    async def refresh_cookie_files_async(self):
+        """То же из обработчиков: stat/scandir папки выполняется в потоке, а не в event loop"""
+        self._apply_cookies_dir(*await asyncio.to_thread(scan_cookies_dir, self.cookies_dir))
 
-# --- МЕНЕДЖЕР РОТАЦИИ COOKIE ДЛЯ TIKTOK ---
-class TikTokCookieRotator:
-    def __init__(self, cookies_dir: str):
-        self.cookies_dir = cookies_dir
-        self.cookie_files = self._load_cookie_files()
-        self.cookie_cycle = itertools.cycle(self.cookie_files) if self.cookie_files else None
-        self.current_cookie_file = None
-
-    def _load_cookie_files(self) -> list:
-        """Загружает все cookie файлы из директории для TikTok"""
-        if not os.path.exists(self.cookies_dir):
-            logger.warning(f"🍪 Cookies directory not found: {self.cookies_dir}")
-            return []
-
-        # Ищем все файлы cookie_tiktok*.txt
-        files = sorted(glob.glob(os.path.join(self.cookies_dir, 'cookie_tiktok*.txt')))
+    def _apply_cookies_dir(self, mtime: int | None, names: list[str]):
+        if mtime == self._dir_mtime:
+            return
+        self._dir_mtime = mtime
 
-        if files:
-            logger.info(f"🍪 Found {len(files)} tiktok cookie files: {[os.path.basename(f) for f in files]}")
+        if mtime is None:
+            logger.warning("🍪 Cookies directory not found: %s", self.cookies_dir)
+            files = {}
         else:
-            logger.warning(f"🍪 No tiktok cookie files found in {self.cookies_dir}")
+            files = self._load_cookie_files(names)
 
-        return files
+        if files.keys() != self.cookie_names.keys():
+            self.cookie_files = list(files)
+            self.cookie_names = files
+            self._idx = 0
 
-    def get_next_cookie(self) -> str:
-        """Возвращает путь к следующему TikTok cookie файлу из ротации"""
-        if not self.cookie_cycle:
-            raise Exception("No available TikTok cookie files")
+    def get_next_cookie(self, exclude=()) -> str:
+        """Возвращает путь к следующему cookie файлу из ротации.
+        exclude - cookie, уже использованные в текущем запросе; cookie на паузе берутся, только если других нет"""
+        if not self.cookie_files:
+            raise Exception(f"No available {self.platform} cookie files")
 
-        self.current_cookie_file = next(self.cookie_cycle)
-        cookie_name = os.path.basename(self.current_cookie_file)
-        logger.info(f"🔄 Switching to tiktok cookie: {cookie_name}")
+        count = len(self.cookie_files)
+        order = [self.cookie_files[(self._idx + offset) % count] for offset in range(count)]
+        candidates = [path for path in order if path not in exclude] or order
+        self.current_cookie_file = next((path for path in candidates if not self.in_cooldown(path)), candidates[0])
+        self._idx = (self.cookie_files.index(self.current_cookie_file) + 1) % count
+        logger.info("🔄 Switching to %s cookie: %s", self.platform.lower(), self.cookie_names[self.current_cookie_file])
 
         return self.current_cookie_file
 
+    def cool_down(self, cookie_path: str):
+        """Ставит cookie на паузу COOKIE_COOLDOWN_SECONDS"""
+        self._cooldown[self.cookie_names.get(cookie_path) or os.path.basename(cookie_path)] = time.time() + COOKIE_COOLDOWN_SECONDS
+
+    def mark_bad(self, cookie_path: str):
+        """Переносит неудачный cookie в конец очереди, чтобы рабочие пробовались первыми"""
+        try:
+            i = self.cookie_files.index(cookie_path)
+        except ValueError:
+            return
+        self.cookie_files.append(self.cookie_files.pop(i))
+        # Сдвиг хвоста списка: следующий по очереди cookie не должен пропускаться
+        if i < self._idx:
+            self._idx -= 1
+
     async def try_with_all_cookies_async(self, process_func, url, temp_folder, *args, **kwargs):
-        """Асинхронно пробует обработать с каждым TikTok cookie по очереди"""
+        """Асинхронно пробует обработать с cookie (проверка + скачивание).
+
+        Одновременно выполняется до COOKIE_PARALLEL_ATTEMPTS попыток, каждая в своей подпапке;
+        на место неудачной запускается следующий cookie, первая успешная отменяет остальные.
+        """
+        await self.refresh_cookie_files_async()
         if not self.cookie_files:
-            raise Exception("No available TikTok cookie files for attempts")
+            raise Exception(f"No available {self.platform} cookie files for attempts")
 
+        label = self.platform.lower()
         attempts_total = len(self.cookie_files)
+        # Cookie на паузе не запускаются параллельно сразу - только если остальные не справились
+        ready_total = sum(not self.in_cooldown(path) for path in self.cookie_files) or attempts_total
+        parallel_attempts = max(1, min(COOKIE_PARALLEL_ATTEMPTS, ready_total))
         last_error = None
+        started = 0
+        pending = {}  # task -> (номер попытки, путь к cookie, папка попытки)
+        used = set()  # cookie этого запроса: ротация общая, и параллельные запросы сдвигают индекс
+
+        def start_next_attempt():
+            nonlocal started
+            cookie_path = self.get_next_cookie(exclude=used)
+            used.add(cookie_path)
+            # Папку создает сам yt-dlp при скачивании
+            attempt_folder = os.path.join(temp_folder, f"cookie_attempt_{started + 1}")
+
+            logger.info("🍪 Attempt %d/%d with %s cookie: %s", started + 1, attempts_total, label, self.cookie_names[cookie_path])
+            task = asyncio.create_task(process_func(cookie_path, url, attempt_folder, *args, **kwargs))
+            pending[task] = (started, cookie_path, attempt_folder)
+            started += 1
 
-        for attempt in range(attempts_total):
-            try:
-                cookie_path = self.get_next_cookie()
-                cookie_name = os.path.basename(cookie_path)
-
-                logger.info(f"🍪 Attempt {attempt + 1}/{attempts_total} with tiktok cookie: {cookie_name}")
-                result = await process_func(cookie_path, url, temp_folder, *args, **kwargs)
-
-                logger.info(f"✅ Successfully processed with tiktok cookie: {cookie_name}")
-                return result
-
-            except Exception as e:
-                last_error = e
-                cookie_name = os.path.basename(self.current_cookie_file) if self.current_cookie_file else "unknown"
-                logger.warning(f"❌ Error with tiktok cookie {cookie_name}: {str(e)}")
+        try:
+            while started < parallel_attempts:
+                start_next_attempt()
 
-                # Отправляем уведомление админу только о реальных ошибках
-                if _current_bot_context and ADMIN_GROUP_ID:
-                    error_details = f"TikTok cookie error for URL: {url}\n"
-                    error_details += f"Cookie file: {cookie_name}\n"
-                    error_details += f"Attempt: {attempt + 1}/{attempts_total}\n"
-                    error_details += f"Cookie path: {cookie_path}\n\n"
-                    error_details += f"Exception: {str(e)}\n\n"
-                    error_details += f"Traceback:\n{traceback.format_exc()}"
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    attempt, cookie_path, attempt_folder = pending.pop(task)
+                    cookie_name = self.cookie_names.get(cookie_path) or os.path.basename(cookie_path)
 
                     try:
-                        await send_error_to_admin(
-                            _current_bot_context,
-                            f"TikTok cookie {cookie_name}: Ошибка при попытке {attempt + 1}/{attempts_total}",
-                            error_details,
-                            "TikTok Cookie"
-                        )
-                    except Exception as admin_error:
-                        logger.error(f"Failed to send tiktok cookie error to admin: {admin_error}")
+                        result = task.result()
+                    except Exception as e:
+                        last_error = e
+                        await asyncio.to_thread(shutil.rmtree, attempt_folder, ignore_errors=True)
+
+                        # Проверяем, является ли это ошибкой "только фото"
+                        if str(e).startswith("PHOTO_ONLY:"):
+                            logger.info("ℹ️ %s cookie %s: Detected photo-only post", self.platform, cookie_name)
+                            # Для фото-постов не пробуем другие cookie, сразу возвращаем ошибку
+                            raise e
+
+                        logger.warning("❌ Error with %s cookie %s: %s", label, cookie_name, e)
+                        self.mark_bad(cookie_path)
+                        # Пауза только при отказе из-за самого cookie (лимит запросов, нужен вход).
+                        # Ошибки поста (удален, приватный, сбой CDN) не говорят ничего о cookie
+                        if isinstance(e, CookieBlockedError):
+                            self.cool_down(cookie_path)
+                            await self.save_cooldowns()
+
+                        if started < attempts_total:
+                            logger.info("🔄 Trying next %s cookie...", label)
+                            start_next_attempt()
+
+                        # Отправляем уведомление админу только о реальных ошибках
+                        bot_context = _current_bot_context.get()
+                        if bot_context and admin_reports_enabled():
+                            error_details = (
+                                f"{self.platform} cookie error for URL: {url}\n"
+                                f"Cookie file: {cookie_name}\n"
+                                f"Attempt: {attempt + 1}/{attempts_total}\n"
+                                f"Cookie path: {cookie_path}\n\n"
+                                f"Exception: {str(e)}\n\n"
+                                f"Traceback:\n{traceback.format_exc()}"
+                            )
 
-                if attempt < attempts_total - 1:
-                    logger.info("🔄 Trying next tiktok cookie...")
+                            try:
+                                await send_error_to_admin(
+                                    bot_context,
+                                    f"{self.platform} cookie {cookie_name}: Ошибка при попытке {attempt + 1}/{attempts_total}",
+                                    error_details,
+                                    f"{self.platform} Cookie"
+                                )
+                            except Exception as admin_error:
+                                logger.error("Failed to send %s cookie error to admin: %s", label, admin_error)
 
-        raise Exception(f"All TikTok cookie files failed. Last error: {last_error}")
+                        continue
+
+                    logger.info("✅ Successfully processed with %s cookie: %s", label, cookie_name)
+                    if self._cooldown.pop(cookie_name, None):
+                        await self.save_cooldowns()
+                    return result
+        finally:
+            # Отменяем оставшиеся попытки и удаляем их частично скачанные файлы. Ожидание короткое:
+            # отмененный run_ytdlp не ждет свой поток, поэтому результат победителя не задерживается
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+                await asyncio.gather(*(
+                    asyncio.to_thread(shutil.rmtree, attempt_folder, ignore_errors=True)
+                    for _, _, attempt_folder in pending.values()
+                ))
+
+        raise Exception(f"All {self.platform} cookie files failed. Last error: {last_error}")
+
+class TikTokCookieRotator(CookieRotator):
+    """Ротация cookie файлов TikTok (cookie_tiktok*.txt)"""
+    file_prefix = 'cookie_tiktok'
+    platform = 'TikTok'
 
 # Глобальные экземпляры ротаторов
 cookie_rotator = CookieRotator(COOKIES_DIR)
 tiktok_cookie_rotator = TikTokCookieRotator(COOKIES_DIR)
 
 # --- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ---
-def find_instagram_url(text: str):
-    pattern = r"(https://www\.instagram\.com/(p|reel)/[a-zA-Z0-9_-]+/?)"
-    match = re.search(pattern, text)
-    return match.group(0) if match else None
-
-def find_tiktok_url(text: str):
-    pattern = r"https?://(?:www\.|vm\.|vt\.)?tiktok\.com/(@[\w\.-]+/video/\d+|[\w-]+)"
-    match = re.search(pattern, text)
-    return match.group(0) if match else None
-
-def find_youtube_shorts_url(text: str):
-    pattern = r"(https?://(?:www\.)?youtube\.com/shorts/[a-zA-Z0-9_-]+)"
-    match = re.search(pattern, text)
-    return match.group(0) if match else None
-
-def resolve_tiktok_url(url: str):
+# Регулярные выражения компилируются один раз при загрузке модуля
+# Одно выражение на все платформы: сообщение просматривается одним search(), платформа - по имени группы.
+# Внутри групп только незахватывающие скобки, иначе match.lastgroup был бы None
+MEDIA_URL_RE = re.compile(
+    r"(?P<instagram>https://www\.instagram\.com/(?:p|reel)/[a-zA-Z0-9_-]+/?)"
+    r"|(?P<tiktok>https?://(?:www\.|vm\.|vt\.)?tiktok\.com/(?:@[\w\.-]+/video/\d+|[\w-]+))"
+    r"|(?P<youtube_shorts>https?://(?:www\.)?youtube\.com/shorts/[a-zA-Z0-9_-]+)"
+)
+
+def find_media_url(text: str) -> tuple[str, str] | None:
+    """Находит первую поддерживаемую ссылку. Возвращает (платформа, ссылка)"""
+    match = MEDIA_URL_RE.search(text)
+    return (match.lastgroup, match.group(0)) if match else None
+
+class TTLCache:
+    """Небольшой LRU-кэш с ограниченным временем жизни записей"""
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+# Общий асинхронный HTTP-клиент: раскрытие коротких ссылок не блокирует event loop
+# и идет по уже открытому keep-alive соединению. Создается в post_init (внутри event loop
+# приложения) и закрывается в post_shutdown
+_http_client: httpx.AsyncClient | None = None
+
+def create_http_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        timeout=10,
+        follow_redirects=True,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60),
+        # Cookie не нужны для раскрытия ссылок: политика без разрешенных доменов ничего не сохраняет,
+        # поэтому jar не растет от Set-Cookie редиректов TikTok
+        cookies=CookieJar(policy=DefaultCookiePolicy(allowed_domains=[])),
+    )
+
+# Раскрытые короткие ссылки TikTok: популярное видео часто присылают несколько раз
+_resolved_tiktok_urls = TTLCache(1024, 3600)
+
+async def resolve_tiktok_url(url: str):
     if "vm.tiktok.com" in url or "vt.tiktok.com" in url:
-        try: return requests.head(url, allow_redirects=True, timeout=10).url
-        except requests.RequestException: return url
+        if resolved := _resolved_tiktok_urls.get(url):
+            return resolved
+        try: resolved = str((await _http_client.head(url)).url)
+        except httpx.HTTPError: return url
+        _resolved_tiktok_urls.set(url, resolved)
+        return resolved
     return url
 
-async def run_subprocess(command: list[str], timeout: int = 300, suppress_stdout_log: bool = False) -> tuple[str, str]:
-    global _last_ytdlp_stderr
+def normalize_url(url: str) -> str:
+    """Приводит ссылку к каноническому виду для кэша: https, хост в нижнем регистре без www, без query и слеша в конце"""
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower().removeprefix("www.")
+    return f"https://{host}{parts.path.rstrip('/')}"
+
+# Telegram file_id уже отправленных видео: повторная ссылка пересылается без скачивания
+_sent_video_cache = TTLCache(SENT_VIDEO_CACHE_SIZE, SENT_VIDEO_CACHE_TTL_SECONDS)
+# Блокировки по ссылке: одновременные запросы одной ссылки ждут первый вместо параллельной загрузки
+_url_locks: dict[str, tuple[asyncio.Lock, int]] = {}
+
+@asynccontextmanager
+async def hold_url_lock(cache_key: str):
+    """Сериализует обработку одной и той же ссылки; запись удаляется, когда ссылку никто не ждет"""
+    lock, users = _url_locks.get(cache_key, (None, 0))
+    if lock is None:
+        lock = asyncio.Lock()
+    _url_locks[cache_key] = (lock, users + 1)
+    try:
+        async with lock:
+            yield
+    finally:
+        lock, users = _url_locks[cache_key]
+        if users == 1:
+            del _url_locks[cache_key]
+        else:
+            _url_locks[cache_key] = (lock, users - 1)
 
-    logger.info(f"🛠 Запуск команды: {' '.join(command)}")
+def remember_sent_video(url: str, message):
+    """Запоминает file_id отправленного видео для повторных запросов той же ссылки"""
+    video = getattr(message, "video", None)
+    if video:
+        _sent_video_cache.set(normalize_url(url), video.file_id)
 
-    process = await asyncio.create_subprocess_exec(
-        *command,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE
-    )
+async def resend_cached_video(update: Update, context: ContextTypes.DEFAULT_TYPE, url: str, platform: str) -> bool:
+    """Пересылает ранее отправленное видео по file_id. Возвращает False, если в кэше ничего нет"""
+    cache_key = normalize_url(url)
+    file_id = _sent_video_cache.get(cache_key)
+    if not file_id:
+        return False
+
+    chat_id, msg_id, user = update.effective_chat.id, update.message.message_id, update.effective_user
     try:
-        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=timeout)
+        await context.bot.send_video(
+            chat_id=chat_id,
+            video=file_id,
+            caption=f"{platform} <a href=\"{url}\">видео</a> отправил {user.mention_html()}",
+            parse_mode="HTML",
+            supports_streaming=True,
+        )
+    except TelegramError as e:
+        logger.warning("⚠️ Failed to resend cached %s video, downloading again: %s", platform, e)
+        _sent_video_cache.pop(cache_key)
+        return False
 
-        # Сохраняем STDERR для отчетов об ошибках
-        stderr_decoded = stderr.decode(errors='ignore')
-        _last_ytdlp_stderr = stderr_decoded
+    logger.info("♻️ Resent cached %s video by file_id: %s", platform, url)
+    try:
+        await context.bot.delete_message(chat_id, msg_id)
+    except TelegramError as e:
+        logger.warning("⚠️ Failed to delete original message: %s", e)
+    return True
+
+async def read_stream_lines(stream: asyncio.StreamReader, max_lines: int | None = None) -> str:
+    """Читает поток построчно по мере вывода; при max_lines хранит только последние строки"""
+    lines = deque(maxlen=max_lines)
+    async for line in stream:
+        lines.append(line.decode(errors='ignore'))
+    return ''.join(lines)
+
+async def run_subprocess(command: list[str], timeout: int = 300, suppress_stdout_log: bool = False) -> tuple[str, str]:
+    logger.info("🛠 Запуск команды: %s", command)
+
+    # Ограничиваем число одновременно запущенных процессов
+    async with _subprocess_semaphore:
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            limit=1024 * 1024,  # Длинные строки (например, JSON в одну строку) не должны обрывать чтение
+        )
+        try:
+            # STDOUT - результат команды, читаем целиком; от STDERR нужен только хвост
+            stdout, stderr, _ = await asyncio.wait_for(
+                asyncio.gather(
+                    read_stream_lines(process.stdout),
+                    read_stream_lines(process.stderr, SUBPROCESS_STDERR_TAIL_LINES),
+                    process.wait(),
+                ),
+                timeout=timeout,
+            )
 
-        # Логируем STDOUT только если не подавлено
-        if stdout and not suppress_stdout_log:
-            logger.info(f"[yt-dlp STDOUT]\n{stdout.decode(errors='ignore')}")
+            # Логируем STDOUT только если не подавлено
+            if stdout and not suppress_stdout_log:
+                logger.info("[subprocess STDOUT]\n%s", stdout)
 
-        # STDERR всегда логируем
-        if stderr_decoded:
-            logger.warning(f"[yt-dlp STDERR]\n{stderr_decoded}")
+            # STDERR всегда логируем
+            if stderr:
+                logger.warning("[subprocess STDERR]\n%s", stderr)
 
-        return stdout.decode(), stderr_decoded
+            return stdout, stderr
+
+        except asyncio.TimeoutError:
+            try:
+                process.kill()
+                raise TimeoutError(f"Command timed out after {timeout} seconds")
+            except ProcessLookupError:
+                pass
+            raise
+        except asyncio.CancelledError:
+            # Задачу отменили - процесс не должен продолжать работать впустую
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
+            raise
 
+class YtDlpLogger:
+    """Логгер для yt-dlp: пишет вывод в наш лог и собирает предупреждения/ошибки (аналог STDERR)"""
+    def __init__(self, log_output: bool = True):
+        self.log_output = log_output
+        # Ошибки yt-dlp в конце вывода, поэтому храним только хвост
+        self.stderr_lines = deque(maxlen=SUBPROCESS_STDERR_TAIL_LINES)
+
+    def debug(self, msg: str):
+        # yt-dlp передает сюда и обычный вывод (to_screen), и отладку с префиксом "[debug] "
+        if self.log_output and not msg.startswith('[debug] '):
+            logger.info("[yt-dlp] %s", msg)
+
+    def info(self, msg: str):
+        self.debug(msg)
+
+    def warning(self, msg: str):
+        self.stderr_lines.append(msg)
+        logger.warning("[yt-dlp] %s", msg)
+
+    def error(self, msg: str):
+        self.stderr_lines.append(msg)
+        logger.warning("[yt-dlp] %s", msg)
+
+    @property
+    def stderr(self) -> str:
+        return "\n".join(self.stderr_lines)
+
+def _ytdlp_worker(source: str | dict, params: dict, download: bool, ydl_logger: YtDlpLogger,
+                  cancel_event: threading.Event) -> dict | None:
+    """Выполняется в отдельном потоке: yt-dlp блокирующий"""
+    def check_cancelled(_progress):
+        # Поток нельзя прервать снаружи, поэтому скачивание останавливаем из progress hook
+        if cancel_event.is_set():
+            raise DownloadCancelled("Download cancelled by bot")
+
+    ydl_params = {
+        **params,
+        'logger': ydl_logger,
+        'quiet': True,
+        'noprogress': True,
+        'progress_hooks': [check_cancelled],
+        'cachedir': YTDLP_CACHE_DIR,
+    }
+    with YoutubeDL(ydl_params) as ydl:
+        if isinstance(source, dict):
+            # Повторно используем info из проверки (как --load-info-json): без повторной
+            # загрузки страницы и извлечения форматов
+            info = ydl.process_ie_result(ydl.sanitize_info(source, remove_private_keys=True), download=download)
+        else:
+            info = ydl.extract_info(source, download=download)
+        info = ydl.sanitize_info(info)
+
+    # С playlist_items=1 (карусели Instagram) нужен первый элемент, как в выводе --dump-json
+    if info and info.get('_type') == 'playlist':
+        info = next((entry for entry in info.get('entries') or [] if entry), None)
+    return info
+
+def _ytdlp_worker_done(worker: asyncio.Future, cancel_event: threading.Event):
+    """Поток yt-dlp завершился: освобождает слот и забирает исключение брошенного запуска,
+    иначе asyncio пишет в лог ошибку "Future exception was never retrieved" """
+    _ytdlp_semaphore.release()
+    if worker.cancelled():
+        return
+    error = worker.exception()
+    if error is not None and cancel_event.is_set():
+        logger.debug("Abandoned yt-dlp run finished with %s: %s", type(error).__name__, error)
+
+async def run_ytdlp(source: str | dict, params: dict, download: bool = False,
+                    timeout: int = 300) -> tuple[dict | None, str]:
+    """Запускает yt-dlp как библиотеку в потоке, без запуска отдельного интерпретатора.
+    source - URL или info, уже полученный ранее (тогда извлечение не повторяется).
+    Возвращает (info, stderr); info = None, если yt-dlp завершился с ошибкой"""
+
+    url = source.get('webpage_url') if isinstance(source, dict) else source
+    logger.info("🛠 Запуск yt-dlp (%s): %s", 'download' if download else 'info', url)
+
+    ydl_logger = YtDlpLogger(log_output=download)
+    cancel_event = threading.Event()
+    info = None
+    try:
+        # Время ожидания свободного слота не входит в timeout самой загрузки
+        await _ytdlp_semaphore.acquire()
+        worker = asyncio.get_running_loop().run_in_executor(
+            _ytdlp_executor, _ytdlp_worker, source, params, download, ydl_logger, cancel_event
+        )
+        # Слот освобождается, когда поток действительно завершился, а не когда вызывающий перестал ждать:
+        # брошенный поток продолжает занимать место в YTDLP_CONCURRENCY
+        worker.add_done_callback(functools.partial(_ytdlp_worker_done, cancel_event=cancel_event))
+        try:
+            info = await asyncio.wait_for(asyncio.shield(worker), timeout=timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            # Поток нельзя прервать снаружи: просим yt-dlp остановиться (сработает в progress hook)
+            # и не ждем его - вызывающий получает ошибку сразу
+            cancel_event.set()
+            raise
     except asyncio.TimeoutError:
+        raise TimeoutError(f"yt-dlp timed out after {timeout} seconds")
+    except DownloadError:
+        # Подробности ошибки уже попали в ydl_logger.stderr
+        pass
+    except YoutubeDLError as e:
+        # Например, "Requested format is not available" при обработке готового info
+        ydl_logger.error(f"ERROR: {e}")
+    finally:
+        # Сохраняем STDERR для отчетов об ошибках
+        if (report_debug := _report_debug.get()) is not None:
+            report_debug['ytdlp_stderr'] = ydl_logger.stderr[-ERROR_REPORT_STDERR_MAX_CHARS:]
+
+    return info, ydl_logger.stderr
+
+# Метаданные видео (ширина, высота, длительность) по (путь, mtime_ns, размер) файла
+_video_metadata_cache = TTLCache(128, 3600)
+
+FFPROBE_VIDEO_ARGS = (
+    'ffprobe', '-v', 'error', '-select_streams', 'v:0',
+    '-show_entries', 'stream=width,height,duration',
+    '-of', 'default=noprint_wrappers=1:nokey=1',
+)
+
+async def downloaded_file_path(info: dict | None) -> str | None:
+    """Путь к итоговому файлу из info yt-dlp (после слияния и перемещения) - без просмотра папки.
+    Размеры и длительность из info запоминаются, чтобы не запускать для файла ffprobe"""
+    for download in reversed((info or {}).get('requested_downloads') or []):
+        file_path = download.get('filepath')
+        if not file_path:
+            continue
         try:
-            process.kill()
-            raise TimeoutError(f"Command timed out after {timeout} seconds")
-        except ProcessLookupError:
-            pass
-        raise
+            stat = await asyncio.to_thread(os.stat, file_path)
+        except OSError:
+            continue
+
+        width = download.get('width') or info.get('width')
+        height = download.get('height') or info.get('height')
+        duration = download.get('duration') or info.get('duration')
+        if width and height and duration:
+            _video_metadata_cache.set(
+                (file_path, stat.st_mtime_ns, stat.st_size),
+                (int(width), int(height), int(float(duration))),
+            )
+        return file_path
+    return None
+
+def clear_folder(folder: str):
+    """Удаляет содержимое папки, оставляя саму папку"""
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                try:
+                    os.unlink(entry.path)
+                except FileNotFoundError:
+                    pass
+
+class TempFolderPool:
+    """Пул заранее созданных временных папок (slot_N), которые переиспользуются между запросами"""
+    def __init__(self, base_dir: str, size: int):
+        self._slots = asyncio.Queue()
+        for i in range(size):
+            folder = os.path.join(base_dir, f"slot_{i}")
+            os.makedirs(folder, exist_ok=True)
+            clear_folder(folder)  # Остатки от предыдущего запуска бота
+            self._slots.put_nowait(folder)
+
+    async def acquire(self) -> str:
+        """Берет свободную папку; если все заняты - ждет освобождения"""
+        return await self._slots.get()
+
+    async def release(self, folder: str):
+        """Очищает папку (в потоке, чтобы медленная ФС не блокировала event loop) и возвращает ее в пул"""
+        try:
+            await asyncio.to_thread(clear_folder, folder)
+        finally:
+            self._slots.put_nowait(folder)
+
+temp_folder_pool = TempFolderPool(TEMP_DOWNLOADS_DIR, TEMP_FOLDER_POOL_SIZE)
+
+# Инициализируем MP3 downloader (временные папки берет из общего пула)
+mp3_downloader = MP3Downloader(temp_folder_pool, TELEGRAM_SIZE_LIMIT_BYTES, run_ytdlp)
+
+def analyze_formats(formats: list[dict], size_limit: int = TELEGRAM_SIZE_LIMIT_BYTES) -> tuple[bool, dict | None]:
+    """Один проход по форматам: (есть ли видеоформат, лучший формат с видео и звуком меньше лимита).
+    Лучший - максимальная высота, затем битрейт; форматы с неизвестным размером не выбираются"""
+    has_video = False
+    best_format = None
+    best_key = None
+    for fmt in formats:
+        vcodec = fmt.get('vcodec')
+        if vcodec and vcodec != 'none':
+            has_video = True
+        if vcodec == 'none' or fmt.get('acodec') == 'none':
+            continue
+        size = fmt.get('filesize') or fmt.get('filesize_approx') or 0
+        if not 0 < size < size_limit:
+            continue
+        key = (fmt.get('height') or 0, fmt.get('tbr') or 0)
+        if best_key is None or key > best_key:
+            best_key, best_format = key, fmt
+    return has_video, best_format
 
 # --- ЛОГИКА СКАЧИВАНИЯ С РОТАЦИЕЙ COOKIE ДЛЯ INSTAGRAM ---
+# Информация о посте/видео (результат проверки yt-dlp) по (нормализованная ссылка, cookie файл):
+# повторная ссылка не запрашивает страницу заново. Cookie входит в ключ, чтобы замена неудачного
+# cookie получала свою проверку, а не повторяла info, с которым скачивание уже не удалось
+_post_info_cache = TTLCache(512, 600)
+
+def post_info_cache_key(url: str, params: dict) -> tuple[str, str | None]:
+    return normalize_url(url), params.get('cookiefile')
+
+async def get_post_info(url: str, params: dict, timeout: int = YTDLP_PROBE_TIMEOUT_SECONDS) -> tuple[dict | None, str]:
+    """Как run_ytdlp(url, params) без скачивания, но с кэшем успешных результатов"""
+    cache_key = post_info_cache_key(url, params)
+    post_info = _post_info_cache.get(cache_key)
+    if post_info:
+        logger.info("✅ Post info from cache: %s", url)
+        return post_info, ""
+
+    post_info, stderr = await run_ytdlp(url, params, timeout=timeout)
+    if post_info and post_info.get('formats'):
+        _post_info_cache.set(cache_key, post_info)
+    return post_info, stderr
+
+def drop_post_info(url: str, params: dict):
+    """Убирает info из кэша после неудачного скачивания: следующая попытка проверит пост заново"""
+    _post_info_cache.pop(post_info_cache_key(url, params))
+
 async def process_instagram_with_cookie(cookie_path: str, url: str, temp_folder: str) -> str:
     """Проверяет содержимое поста и скачивает Instagram видео с конкретным cookie файлом"""
 
     # Сначала проверяем содержимое поста
-    logger.info(f"🔍 Checking Instagram post content with cookie: {os.path.basename(cookie_path)}")
-
-    check_command = [
-        'yt-dlp',
-        *get_ytdlp_network_options(),
-        '--dump-json',
-        '--no-warnings',
-        '--playlist-items', '1',
-        '--cookies', cookie_path,
-        '--add-header', 'User-Agent: Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36 Edg/138.0.0.0',
-        url
-    ]
+    logger.info("🔍 Checking Instagram post content with cookie: %s", cookie_path)
 
-    # Подавляем STDOUT логирование для команды проверки
-    stdout, stderr = await run_subprocess(check_command, timeout=90, suppress_stdout_log=True)
+    check_params = {
+        **get_ytdlp_network_options(),
+        'no_warnings': True,
+        'playlist_items': '1',
+        'cookiefile': cookie_path,
+        'http_headers': INSTAGRAM_HTTP_HEADERS,
+    }
+
+    post_info, stderr = await get_post_info(url, check_params)
 
     # Проверяем, содержит ли STDERR сообщение о том, что видео форматы не найдены
     if "No video formats found!" in stderr:
-        logger.info(f"ℹ️ Instagram post contains only images/photos (no video formats found)")
+        logger.info("ℹ️ Instagram post contains only images/photos (no video formats found)")
         raise Exception("PHOTO_ONLY:В этом посте только фотографии, видео отсутствует")
 
-    if not stdout.strip():
+    if not post_info:
+        raise_if_cookie_blocked(stderr)
         raise Exception("Не удалось получить информацию о посте")
 
-    try:
-        post_info = json.loads(stdout)
-    except json.JSONDecodeError:
-        raise Exception("Ошибка обработки информации о посте")
-
     # Проверяем наличие видео в посте (дополнительная проверка)
-    formats = post_info.get('formats', [])
-    has_video_format = False
-
-    for format_info in formats:
-        # Ищем форматы с видео (не только аудио)
-        if format_info.get('vcodec') and format_info.get('vcodec') != 'none':
-            has_video_format = True
-            break
+    has_video_format, _ = analyze_formats(post_info.get('formats', []))
 
     # Дополнительная проверка через duration
     duration = post_info.get('duration')
 
     # Если нет видео форматов и нет длительности
     if not has_video_format and (not duration or duration <= 0):
-        logger.info(f"ℹ️ Instagram post contains only images/photos (no video formats in JSON)")
+        logger.info("ℹ️ Instagram post contains only images/photos (no video formats in JSON)")
         raise Exception("PHOTO_ONLY:В этом посте только фотографии, видео отсутствует")
 
-    logger.info(f"✅ Instagram post contains video content, proceeding with download")
+    logger.info("✅ Instagram post contains video content, proceeding with download")
 
     # Если видео есть, скачиваем его
     format_selector = "best[height<=720][ext=mp4]/best[ext=mp4]/best[height<=720]/best"
 
-    yt_dlp_download_command = [
-        'yt-dlp', url,
-        '--playlist-items', '1',
-        '-f', format_selector,
-        '-o', os.path.join(temp_folder, 'final_video.%(ext)s'),
-        '--no-warnings',
-        '--cookies', cookie_path,
-        '--add-header', 'User-Agent: Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36 Edg/138.0.0.0',
-        *get_ytdlp_network_options()
-    ]
+    download_params = {
+        **check_params,
+        'format': format_selector,
+        'outtmpl': os.path.join(temp_folder, 'final_video.%(ext)s'),
+    }
 
     try:
-        await run_subprocess(yt_dlp_download_command)
+        downloaded_info, stderr = await run_ytdlp(post_info, download_params, download=True)
     except Exception:
+        downloaded_info = None
+
+    if not downloaded_info:
         # План Б: fallback на любой best
         logger.warning("Failed to download format <= 720p, trying best available...")
-        yt_dlp_download_command[5] = "best"
-        await run_subprocess(yt_dlp_download_command)
+        try:
+            downloaded_info, stderr = await run_ytdlp(post_info, {**download_params, 'format': 'best'}, download=True)
+        except Exception:
+            drop_post_info(url, check_params)
+            raise
 
-    video_files = glob.glob(os.path.join(temp_folder, '*.mp4'))
-    if not video_files:
+    video_path = await downloaded_file_path(downloaded_info)
+    if not video_path or not video_path.endswith('.mp4'):
+        drop_post_info(url, check_params)
+        raise_if_cookie_blocked(stderr)
         raise Exception("Video file not created")
 
-    return video_files[0]
+    return video_path
 
 async def download_video_with_yt_dlp_instagram(url: str, temp_folder: str) -> tuple[str | None, str | None]:
     """Скачивает Instagram видео с ротацией cookie. Возвращает (video_path, error_message)"""
     try:
-        logger.info(f"🎬 Starting Instagram processing: {url}")
+        logger.info("🎬 Starting Instagram processing: %s", url)
 
         video_path = await cookie_rotator.try_with_all_cookies_async(
             process_instagram_with_cookie,
@@ -627,7 +1157,7 @@ async def download_video_with_yt_dlp_instagram(url: str, temp_folder: str) -> tu
             temp_folder
         )
 
-        logger.info(f"✅ Instagram video successfully downloaded: {video_path}")
+        logger.info("✅ Instagram video successfully downloaded: %s", video_path)
         return video_path, None
 
     except Exception as e:
@@ -635,177 +1165,221 @@ async def download_video_with_yt_dlp_instagram(url: str, temp_folder: str) -> tu
         if error_msg.startswith("PHOTO_ONLY:"):
             # Это сообщение о том, что в посте только фото
             photo_msg = error_msg.replace("PHOTO_ONLY:", "")
-            logger.info(f"ℹ️ Instagram post is photo-only: {url}")
+            logger.info("ℹ️ Instagram post is photo-only: %s", url)
             return None, photo_msg
         else:
-            logger.error(f"❌ Failed to download Instagram video: {e}")
+            logger.error("❌ Failed to download Instagram video: %s", e)
             return None, None
 
 # --- ЛОГИКА СКАЧИВАНИЯ С РОТАЦИЕЙ COOKIE ДЛЯ TIKTOK ---
 async def process_tiktok_with_cookie(cookie_path: str, url: str, temp_folder: str) -> str:
     """Скачивает TikTok видео с конкретным cookie файлом"""
-    logger.info(f"🎬 TikTok: Getting available formats for URL: {url} with cookie: {os.path.basename(cookie_path)}")
-
-    # Команда для получения информации с cookies
-    yt_dlp_list_command = [
-        'yt-dlp',
-        *get_ytdlp_network_options(),
-        '--dump-json',
-        '--cookies', cookie_path,
-        '--add-header', 'User-Agent: Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36',
-        url
-    ]
+    logger.info("🎬 TikTok: Getting available formats for URL: %s with cookie: %s", url, cookie_path)
+
+    # Параметры для получения информации с cookies
+    list_params = {
+        **get_ytdlp_network_options(),
+        'cookiefile': cookie_path,
+        'http_headers': TIKTOK_HTTP_HEADERS,
+    }
 
-    stdout, stderr = await run_subprocess(yt_dlp_list_command, timeout=90, suppress_stdout_log=True)
+    video_info, stderr = await get_post_info(url, list_params)
 
     # Проверяем ошибки аутентификации
     if "This post may not be comfortable for some audiences" in stderr or "Log in for access" in stderr:
-        raise Exception("TikTok требует аутентификации - пост может быть ограничен")
+        raise CookieBlockedError("TikTok требует аутентификации - пост может быть ограничен")
 
-    if not stdout.strip():
+    if not video_info:
+        raise_if_cookie_blocked(stderr)
         raise Exception("Не удалось получить информацию о TikTok видео")
 
-    video_info = json.loads(stdout)
-
     logger.info("🎬 TikTok: Selecting best format under 50 MB...")
-    candidate_formats = []
-    for f in video_info.get('formats', []):
-        if f.get('vcodec') != 'none' and f.get('acodec') != 'none':
-            filesize = f.get('filesize') or f.get('filesize_approx')
-            if filesize and filesize < TELEGRAM_SIZE_LIMIT_BYTES:
-                candidate_formats.append(f)
-
-    if not candidate_formats:
+    _, best_format = analyze_formats(video_info.get('formats', []))
+    if not best_format:
         raise Exception("No suitable video formats found under 50 MB")
 
-    best_format = sorted(candidate_formats, key=lambda x: (x.get('height') or 0, x.get('tbr') or 0), reverse=True)[0]
     chosen_format_str = best_format['format_id']
-    logger.info(f"✅ TikTok: Selected best format ({best_format.get('height')}p) with ID: {chosen_format_str}")
+    logger.info("✅ TikTok: Selected best format (%sp) with ID: %s", best_format.get('height'), chosen_format_str)
 
     logger.info("⬬ TikTok: Downloading selected format...")
-    yt_dlp_download_command = [
-        'yt-dlp', url,
-        '-f', chosen_format_str,
-        '-o', os.path.join(temp_folder, 'final_video.%(ext)s'),
-        '--no-warnings',
-        '--cookies', cookie_path,
-        '--add-header', 'User-Agent: Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36',
-        *get_ytdlp_network_options()
-    ]
+    download_params = {
+        **list_params,
+        'format': chosen_format_str,
+        'outtmpl': os.path.join(temp_folder, 'final_video.%(ext)s'),
+        'no_warnings': True,
+    }
 
-    await run_subprocess(yt_dlp_download_command)
+    try:
+        downloaded_info, stderr = await run_ytdlp(video_info, download_params, download=True)
+    except Exception:
+        drop_post_info(url, list_params)
+        raise
 
-    video_files = glob.glob(os.path.join(temp_folder, 'final_video.*'))
-    if video_files:
-        logger.info(f"✅ TikTok video successfully downloaded: {video_files[0]}")
-        return video_files[0]
+    video_path = await downloaded_file_path(downloaded_info)
+    if video_path:
+        logger.info("✅ TikTok video successfully downloaded: %s", video_path)
+        return video_path
     else:
+        drop_post_info(url, list_params)
+        raise_if_cookie_blocked(stderr)
         raise Exception("yt-dlp did not create final file")
 
+# TikTok видео, которым без cookie нужна авторизация: для них сразу используем ротацию cookie
+_tiktok_needs_cookies = TTLCache(1024, 24 * 3600)
+TIKTOK_VIDEO_ID_RE = re.compile(r"/video/(\d+)")
+
+def tiktok_cache_key(url: str) -> str:
+    """Ключ TikTok видео: его ID, если он есть в ссылке, иначе нормализованная ссылка"""
+    match = TIKTOK_VIDEO_ID_RE.search(url)
+    return match.group(1) if match else normalize_url(url)
+
+async def download_tiktok_with_cookies(url: str, temp_folder: str) -> tuple[str | None, str | None]:
+    """Скачивает TikTok видео через ротацию cookie. Возвращает (video_path, error_message)"""
+    await tiktok_cookie_rotator.refresh_cookie_files_async()
+    if not tiktok_cookie_rotator.cookie_files:
+        logger.warning("❌ TikTok: No cookie files available for restricted content")
+        return None, "Этот TikTok пост требует авторизации, но TikTok cookies не настроены"
+
+    # Используем механизм ротации TikTok cookies
+    try:
+        video_path = await tiktok_cookie_rotator.try_with_all_cookies_async(
+            process_tiktok_with_cookie,
+            url,
+            temp_folder
+        )
+        return video_path, None
+    except Exception as cookie_error:
+        # Только здесь возвращаем None, None чтобы вызвать отправку админу
+        logger.error("❌ All TikTok cookies failed: %s", cookie_error)
+        return None, None
+
 async def download_video_with_yt_dlp_tiktok(url: str, temp_folder: str) -> tuple[str | None, str | None]:
     """Скачивает TikTok видео с поддержкой cookies. Возвращает (video_path, error_message)"""
+    cache_key = tiktok_cache_key(url)
+    if _tiktok_needs_cookies.get(cache_key):
+        logger.info("🍪 TikTok: URL is known to require authentication, skipping cookieless attempt: %s", url)
+        return await download_tiktok_with_cookies(url, temp_folder)
 
     # Сначала пробуем без cookies
     try:
-        logger.info(f"🎬 TikTok: Trying without cookies first for URL: {url}")
+        logger.info("🎬 TikTok: Trying without cookies first for URL: %s", url)
 
-        yt_dlp_list_command = ['yt-dlp', *get_ytdlp_network_options(), '--dump-json', url]
-        stdout, stderr = await run_subprocess(yt_dlp_list_command, timeout=90, suppress_stdout_log=True)
+        info_params = get_ytdlp_network_options()
+        video_info, stderr = await get_post_info(url, info_params)
 
         # Если в stderr есть сообщение об ограничении, переходим к cookies
         if "This post may not be comfortable for some audiences" in stderr or "Log in for access" in stderr:
             logger.info("🍪 TikTok: Authentication required, trying with cookies...")
-
-            if not tiktok_cookie_rotator.cookie_files:
-                logger.warning("❌ TikTok: No cookie files available for restricted content")
-                return None, "Этот TikTok пост требует авторизации, но TikTok cookies не настроены"
-
-            # Используем механизм ротации TikTok cookies
-            try:
-                video_path = await tiktok_cookie_rotator.try_with_all_cookies_async(
-                    process_tiktok_with_cookie,
-                    url,
-                    temp_folder
-                )
-                return video_path, None
-            except Exception as cookie_error:
-                # Только здесь возвращаем None, None чтобы вызвать отправку админу
-                logger.error(f"❌ All TikTok cookies failed: {cookie_error}")
-                return None, None
+            _tiktok_needs_cookies.set(cache_key, True)
+            return await download_tiktok_with_cookies(url, temp_folder)
 
         # Если нет ограничений, продолжаем обычную загрузку без cookies
-        video_info = json.loads(stdout)
+        if not video_info:
+            raise Exception("Не удалось получить информацию о TikTok видео")
 
         logger.info("🎬 TikTok: Selecting best format under 50 MB...")
-        candidate_formats = []
-        for f in video_info.get('formats', []):
-            if f.get('vcodec') != 'none' and f.get('acodec') != 'none':
-                filesize = f.get('filesize') or f.get('filesize_approx')
-                if filesize and filesize < TELEGRAM_SIZE_LIMIT_BYTES:
-                    candidate_formats.append(f)
-
-        if not candidate_formats:
+        _, best_format = analyze_formats(video_info.get('formats', []))
+        if not best_format:
             # Это ошибка без попытки cookies - не отправляем админу
             return None, "Нет подходящих форматов видео под 50 МБ"
 
-        best_format = sorted(candidate_formats, key=lambda x: (x.get('height') or 0, x.get('tbr') or 0), reverse=True)[0]
         chosen_format_str = best_format['format_id']
-        logger.info(f"✅ TikTok: Selected best format ({best_format.get('height')}p) with ID: {chosen_format_str}")
+        logger.info("✅ TikTok: Selected best format (%sp) with ID: %s", best_format.get('height'), chosen_format_str)
 
         logger.info("⬬ TikTok: Downloading selected format...")
-        yt_dlp_download_command = [
-            'yt-dlp', url, '-f', chosen_format_str,
-            '-o', os.path.join(temp_folder, 'final_video.%(ext)s'), '--no-warnings',
-            *get_ytdlp_network_options()
-        ]
-        await run_subprocess(yt_dlp_download_command)
-
-        video_files = glob.glob(os.path.join(temp_folder, 'final_video.*'))
-        if video_files:
-            logger.info(f"✅ TikTok video successfully downloaded: {video_files[0]}")
-            return video_files[0], None
+        download_params = {
+            **get_ytdlp_network_options(),
+            'format': chosen_format_str,
+            'outtmpl': os.path.join(temp_folder, 'final_video.%(ext)s'),
+            'no_warnings': True,
+        }
+        try:
+            downloaded_info, _ = await run_ytdlp(video_info, download_params, download=True)
+        except Exception:
+            drop_post_info(url, info_params)
+            raise
+
+        video_path = await downloaded_file_path(downloaded_info)
+        if video_path:
+            logger.info("✅ TikTok video successfully downloaded: %s", video_path)
+            return video_path, None
         else:
+            drop_post_info(url, info_params)
             # Это ошибка без попытки cookies - не отправляем админу
             return None, "Не удалось создать видеофайл"
 
     except Exception as e:
         # Это ошибка при попытке без cookies - не отправляем админу
         error_msg = str(e)
-        logger.error(f"❌ Failed to download TikTok video without cookies: {e}")
+        logger.error("❌ Failed to download TikTok video without cookies: %s", e)
         return None, f"Ошибка скачивания: {error_msg}"
 
+# Последний сработавший формат/селектор YouTube по (хост, есть ли >= 720p): пробуется первым.
+# ID форматов YouTube одинаковы для разных видео, поэтому обычно срабатывает с первой попытки
+_youtube_format_cache: dict[tuple[str, bool], str] = {}
+
+async def download_youtube_format(source: str | dict, base_params: dict, selector: str, temp_folder: str,
+                                  timeout: int = 240) -> str | None:
+    """Скачивает YouTube видео одним форматом/селектором. source - URL или уже полученный info.
+    Возвращает путь или None"""
+    params = {**base_params, 'format': selector, 'outtmpl': os.path.join(temp_folder, 'final_video.%(ext)s')}
+    if '+' in selector:
+        params['merge_output_format'] = 'mp4'
+
+    downloaded_info, stderr = await run_ytdlp(source, params, download=True, timeout=timeout)
+    if "HTTP Error 403" in stderr:
+        logger.warning("⚠️ HTTP 403 Forbidden detected for format %s", selector)
+        return None
+
+    file_path = await downloaded_file_path(downloaded_info)
+    if not file_path:
+        return None
+
+    file_size = await asyncio.to_thread(os.path.getsize, file_path)
+    if file_size > TELEGRAM_SIZE_LIMIT_BYTES:
+        logger.warning("⚠️ Downloaded file too large: %.1fMB, removing", file_size/1024/1024)
+        await asyncio.to_thread(os.remove, file_path)
+        return None
+
+    logger.info("✅ Downloaded with format %s: %s (%.1fMB)", selector, file_path, file_size/1024/1024)
+    return file_path
+
 async def download_video_with_yt_dlp_youtube_shorts(url: str, temp_folder: str) -> str | None:
     """Скачивает YouTube Shorts с гарантированным звуком, приоритет 720p и выше"""
     logger.info("🎬 YouTube Shorts: Getting available formats...")
 
     # Получаем информацию о доступных форматах
-    info_command = [
-        'yt-dlp', *get_ytdlp_network_options(), '--dump-json', '--no-warnings',
-        '--add-header', 'User-Agent: Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36 Edg/138.0.0.0',
-        '--add-header', 'Referer: https://www.youtube.com/',
-        url
-    ]
-
-    # До 3 попыток для получения информации
-    for info_attempt in range(1, 4):
+    info_params = {
+        **get_ytdlp_network_options(),
+        'no_warnings': True,
+        'http_headers': YOUTUBE_HTTP_HEADERS,
+    }
+
+    # Вместо одинаковых повторов пробуем разные варианты запроса: следующий запускается только после
+    # неудачи предыдущего. Параллельный запуск не годится: извлечение info в потоке нельзя прервать,
+    # и "проигравшие" запросы продолжали бы работать и занимать слоты yt-dlp
+    info_variants = {
+        "default": info_params,
+        "ipv4": {**info_params, 'source_address': '0.0.0.0'},  # --force-ipv4
+        "yt-dlp headers": {key: value for key, value in info_params.items() if key != 'http_headers'},
+    }
+    video_info = None
+    for variant, params in info_variants.items():
+        logger.info("🔍 YouTube Shorts: Getting info via '%s' variant", variant)
         try:
-            logger.info(f"🔍 YouTube Shorts: Getting info attempt {info_attempt}/3")
-            stdout, stderr = await run_subprocess(info_command, timeout=90, suppress_stdout_log=True)
-
-            if not stdout.strip():
-                logger.warning(f"⚠️ Empty response on info attempt {info_attempt}")
-                continue
+            info, _ = await run_ytdlp(url, params, timeout=YTDLP_PROBE_TIMEOUT_SECONDS)
+        except Exception as e:
+            logger.warning("❌ Info variant '%s' failed: %s", variant, e)
+            continue
 
-            video_info = json.loads(stdout)
+        if info:
+            logger.info("✅ YouTube Shorts: Got info via '%s' variant", variant)
+            video_info = info
             break
+        logger.warning("⚠️ Empty response from info variant '%s'", variant)
 
-        except Exception as e:
-            logger.warning(f"❌ Info attempt {info_attempt} failed: {e}")
-            if info_attempt == 3:
-                logger.error("❌ All info attempts failed for YouTube Shorts")
-                return None
-            continue
-    else:
+    if not video_info:
+        logger.error("❌ All info attempts failed for YouTube Shorts")
         return None
 
     # Проверяем доступные форматы
@@ -820,14 +1394,18 @@ async def download_video_with_yt_dlp_youtube_shorts(url: str, temp_folder: str)
     combined_formats = []  # Форматы с видео и аудио
     video_only_formats = []  # Только видео
     audio_formats = []  # Только аудио
+    duration = video_info.get('duration') or 0
 
     for fmt in formats:
         vcodec = fmt.get('vcodec', 'none')
         acodec = fmt.get('acodec', 'none')
-        height = fmt.get('height', 0)
-        ext = fmt.get('ext', '')
-        filesize = fmt.get('filesize') or fmt.get('filesize_approx', 0)
-        tbr = fmt.get('tbr', 0)
+        # yt-dlp отдает None для неизвестных значений, поэтому `or 0`, а не значение по умолчанию get()
+        height = fmt.get('height') or 0
+        ext = fmt.get('ext') or ''
+        tbr = fmt.get('tbr') or 0
+        # Если размер неизвестен, оцениваем по битрейту (кбит/с -> байт/с = * 125), чтобы отсеять
+        # слишком большие форматы до скачивания, а не после
+        filesize = fmt.get('filesize') or fmt.get('filesize_approx') or int(tbr * 125 * duration)
         format_id = fmt.get('format_id', '')
 
         if vcodec != 'none' and acodec != 'none':
@@ -859,86 +1437,112 @@ async def download_video_with_yt_dlp_youtube_shorts(url: str, temp_folder: str)
                 'ext': ext,
                 'filesize': filesize,
                 'tbr': tbr,
-                'abr': fmt.get('abr', 0),
+                'abr': fmt.get('abr') or 0,
                 'type': 'audio_only'
             })
 
-    logger.info(f"📊 Found formats: {len(combined_formats)} combined, {len(video_only_formats)} video-only, {len(audio_formats)} audio-only")
-
-    base_command = [
-        'yt-dlp', '--rm-cache-dir', '--force-ipv4',
-        *get_ytdlp_network_options(),
-        '--add-header', 'User-Agent: Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36 Edg/138.0.0.0',
-        '--add-header', 'Referer: https://www.youtube.com/',
-        '--http-chunk-size', '10M',
-        url,
-        '--playlist-items', '1',
-        '-o', os.path.join(temp_folder, 'final_video.%(ext)s'),
-        '--no-warnings'
-    ]
+    logger.info("📊 Found formats: %s combined, %s video-only, %s audio-only", len(combined_formats), len(video_only_formats), len(audio_formats))
+
+    base_params = {
+        'source_address': '0.0.0.0',  # --force-ipv4
+        **get_ytdlp_network_options(),
+        'http_headers': YOUTUBE_HTTP_HEADERS,
+        'http_chunk_size': 10 * 1024 * 1024,
+        'playlist_items': '1',
+        'no_warnings': True,
+    }
+
+    # СТРАТЕГИЯ 0: Формат, который сработал в прошлый раз для такого же хоста и качества
+    format_cache_key = (
+        normalize_url(url).split('/')[2],
+        any(fmt['height'] >= 720 for fmt in combined_formats + video_only_formats),
+    )
+    cached_selector = _youtube_format_cache.get(format_cache_key)
+    combined_ids = {fmt['format_id'] for fmt in combined_formats}
+    # Если кэширован ID комбинированного формата, которого у видео нет, - не тратим попытку
+    if cached_selector and (cached_selector in combined_ids or not cached_selector.isdigit()):
+        logger.info("⚡ YouTube Shorts: Trying previously successful format first: %s", cached_selector)
+        try:
+            file_path = await download_youtube_format(video_info, base_params, cached_selector, temp_folder, timeout=60)
+            if file_path:
+                return file_path
+        except Exception as e:
+            logger.warning("❌ Cached format %s failed: %s", cached_selector, e)
+        _youtube_format_cache.pop(format_cache_key, None)
+
+    # Все попытки ниже используют уже полученный video_info: страница и плеер не загружаются заново
 
     # СТРАТЕГИЯ 1: Пробуем комбинированные форматы (видео+аудио в одном файле)
     if combined_formats:
         logger.info("🔥 YouTube Shorts: Trying combined video+audio formats...")
 
-        # Группируем по разрешению и сортируем: >= 720p сначала, потом < 720p
-        resolution_groups = {}
-        for fmt in combined_formats:
-            height = fmt['height']
-            if height not in resolution_groups:
-                resolution_groups[height] = []
-            resolution_groups[height].append(fmt)
-
-        available_resolutions = sorted(resolution_groups.keys())
-        high_quality = sorted([r for r in available_resolutions if r >= 720])
-        low_quality = sorted([r for r in available_resolutions if r < 720], reverse=True)
-        resolution_priority = high_quality + low_quality
-
-        logger.info(f"🎯 Combined format resolution priority: {resolution_priority}")
-
-        for resolution in resolution_priority:
-            formats_for_resolution = resolution_groups[resolution]
-            # Сортируем: MP4 сначала, потом по битрейту
-            formats_for_resolution.sort(key=lambda x: (x['is_mp4'], x['tbr']), reverse=True)
-
-            for fmt in formats_for_resolution:
-                quality_tier = "🔥 PREFERRED" if resolution >= 720 else "💀 FALLBACK"
-
-                # Проверяем размер файла
-                if fmt['filesize'] and fmt['filesize'] > TELEGRAM_SIZE_LIMIT_BYTES:
-                    logger.info(f"⚠️ {quality_tier} Skipping combined format {fmt['format_id']} ({resolution}p) - too large: {fmt['filesize']/1024/1024:.1f}MB")
-                    continue
-
-                logger.info(f"🎵 {quality_tier} Trying COMBINED format {fmt['format_id']} ({resolution}p, {fmt['ext']}) - guaranteed audio!")
-
-                command = base_command.copy()
-                command.extend(['-f', fmt['format_id']])
-
-                try:
-                    stdout, stderr = await run_subprocess(command, timeout=240)
-
-                    if "HTTP Error 403" in stderr:
-                        logger.warning("⚠️ HTTP 403 Forbidden detected, trying next format...")
-                        continue
-
-                    video_files = glob.glob(os.path.join(temp_folder, 'final_video.*'))
-                    if video_files:
-                        file_path = video_files[0]
-                        file_size = os.path.getsize(file_path)
-
-                        if file_size > TELEGRAM_SIZE_LIMIT_BYTES:
-                            logger.warning(f"⚠️ Downloaded file too large: {file_size/1024/1024:.1f}MB, removing and trying next format")
-                            os.remove(file_path)
-                            continue
-
-                        quality_log = "🔥 EXCELLENT" if resolution >= 720 else "💀 ACCEPTABLE"
-                        logger.info(f"✅ {quality_log} SUCCESS! Downloaded {resolution}p COMBINED video+audio: {file_path} ({file_size/1024/1024:.1f}MB)")
-                        return file_path
-                    else:
-                        logger.warning(f"⚠️ No video file created for combined format {fmt['format_id']}")
+        # Один проход сортировки дает итоговый порядок попыток: сначала >= 720p по возрастанию,
+        # затем < 720p по убыванию; внутри разрешения MP4 сначала, потом по битрейту
+        ordered_formats = sorted(combined_formats, key=lambda x: (
+            x['height'] < 720,
+            x['height'] if x['height'] >= 720 else -x['height'],
+            not x['is_mp4'],
+            -x['tbr'],
+        ))
+
+        logger.info("🎯 Combined format resolution priority: %s", list(dict.fromkeys(x['height'] for x in ordered_formats)))
+
+        candidates = []
+        for fmt in ordered_formats:
+            # Проверяем размер файла
+            if fmt['filesize'] and fmt['filesize'] > TELEGRAM_SIZE_LIMIT_BYTES:
+                quality_tier = "🔥 PREFERRED" if fmt['height'] >= 720 else "💀 FALLBACK"
+                logger.info("⚠️ %s Skipping combined format %s (%sp) - too large: %.1fMB", quality_tier, fmt['format_id'], fmt['height'], fmt['filesize']/1024/1024)
+                continue
+            candidates.append(fmt)
 
-                except Exception as e:
-                    logger.warning(f"❌ Failed combined format {fmt['format_id']} ({resolution}p): {str(e)}")
+        # До YOUTUBE_PARALLEL_FORMATS форматов скачиваются одновременно, каждый в своей подпапке.
+        # Результат принимается в порядке приоритета: более качественный формат важнее более быстрого,
+        # но неудачные форматы больше не ждут друг друга по очереди
+        window = []  # (формат, папка, задача) в порядке приоритета
+        next_index = 0
+        try:
+            while window or next_index < len(candidates):
+                while len(window) < YOUTUBE_PARALLEL_FORMATS and next_index < len(candidates):
+                    fmt = candidates[next_index]
+                    candidate_folder = os.path.join(temp_folder, f"cand{next_index}")  # создается yt-dlp
+                    quality_tier = "🔥 PREFERRED" if fmt['height'] >= 720 else "💀 FALLBACK"
+                    logger.info("🎵 %s Trying COMBINED format %s (%sp, %s) - guaranteed audio!", quality_tier, fmt['format_id'], fmt['height'], fmt['ext'])
+                    task = asyncio.create_task(
+                        download_youtube_format(video_info, base_params, fmt['format_id'], candidate_folder)
+                    )
+                    window.append((fmt, candidate_folder, task))
+                    next_index += 1
+
+                await asyncio.wait([task for _, _, task in window if not task.done()],
+                                   return_when=asyncio.FIRST_COMPLETED)
+
+                while window and window[0][2].done():
+                    fmt, candidate_folder, task = window.pop(0)
+                    resolution = fmt['height']
+                    try:
+                        file_path = task.result()
+                        if file_path:
+                            quality_log = "🔥 EXCELLENT" if resolution >= 720 else "💀 ACCEPTABLE"
+                            logger.info("✅ %s SUCCESS! Downloaded %sp COMBINED video+audio: %s", quality_log, resolution, file_path)
+                            _youtube_format_cache[format_cache_key] = fmt['format_id']
+                            return file_path
+                        logger.warning("⚠️ No usable video file for combined format %s, trying next format", fmt['format_id'])
+                    except Exception as e:
+                        logger.warning("❌ Failed combined format %s (%sp): %s", fmt['format_id'], resolution, e)
+
+                    await asyncio.to_thread(shutil.rmtree, candidate_folder, ignore_errors=True)
+        finally:
+            # Отменяем менее приоритетные загрузки и удаляем их частичные файлы. Ожидание короткое:
+            # отмененный run_ytdlp не ждет свой поток, поэтому найденный формат отправляется сразу
+            for _, _, task in window:
+                task.cancel()
+            if window:
+                await asyncio.gather(*(task for _, _, task in window), return_exceptions=True)
+                await asyncio.gather(*(
+                    asyncio.to_thread(shutil.rmtree, candidate_folder, ignore_errors=True)
+                    for _, candidate_folder, _ in window
+                ))
 
     # СТРАТЕГИЯ 2: Используем умные селекторы yt-dlp для автоматического объединения
     logger.info("🔄 YouTube Shorts: Trying smart format selectors for auto-merging...")
@@ -961,85 +1565,109 @@ async def download_video_with_yt_dlp_youtube_shorts(url: str, temp_folder: str)
         has_audio_guarantee = "+bestaudio" in selector or "bestvideo+bestaudio" in selector
         audio_note = "🎵 GUARANTEED AUDIO" if has_audio_guarantee else "⚠️ may lack audio"
 
-        logger.info(f"🎯 {selector_type} Trying smart selector: {selector} ({audio_note})")
-
-        command = base_command.copy()
-        command.extend(['-f', selector])
-
-        # Если селектор содержит объединение, добавляем флаг для merge
-        if '+' in selector:
-            command.extend(['--merge-output-format', 'mp4'])
+        logger.info("🎯 %s Trying smart selector: %s (%s)", selector_type, selector, audio_note)
 
         try:
-            stdout, stderr = await run_subprocess(command, timeout=300)  # Больше времени для merge
-
-            video_files = glob.glob(os.path.join(temp_folder, 'final_video.*'))
-            if video_files:
-                file_path = video_files[0]
-                file_size = os.path.getsize(file_path)
-
-                if file_size > TELEGRAM_SIZE_LIMIT_BYTES:
-                    logger.warning(f"⚠️ Smart selector file too large: {file_size/1024/1024:.1f}MB")
-                    os.remove(file_path)
-                    continue
-
+            # Больше времени для merge
+            file_path = await download_youtube_format(video_info, base_params, selector, temp_folder, timeout=300)
+            if file_path:
                 audio_status = "🎵 WITH AUDIO" if has_audio_guarantee else "❓ audio unknown"
-                logger.info(f"✅ SUCCESS with smart selector {selector}: {file_path} ({file_size/1024/1024:.1f}MB) {audio_status}")
+                logger.info("✅ SUCCESS with smart selector %s: %s %s", selector, file_path, audio_status)
+                _youtube_format_cache[format_cache_key] = selector
                 return file_path
 
         except Exception as e:
-            logger.warning(f"❌ Failed smart selector {selector}: {str(e)}")
+            logger.warning("❌ Failed smart selector %s: %s", selector, e)
 
     # СТРАТЕГИЯ 3: Последний шанс - простые селекторы
     logger.info("🆘 YouTube Shorts: Last resort - simple selectors...")
     simple_selectors = ["best", "worst"]
 
     for selector in simple_selectors:
-        logger.info(f"🆘 LAST RESORT: Trying simple selector: {selector}")
-
-        command = base_command.copy()
-        command.extend(['-f', selector])
+        logger.info("🆘 LAST RESORT: Trying simple selector: %s", selector)
 
         try:
-            stdout, stderr = await run_subprocess(command, timeout=240)
-
-            video_files = glob.glob(os.path.join(temp_folder, 'final_video.*'))
-            if video_files:
-                file_path = video_files[0]
-                file_size = os.path.getsize(file_path)
-
-                if file_size > TELEGRAM_SIZE_LIMIT_BYTES:
-                    logger.warning(f"⚠️ Last resort file too large: {file_size/1024/1024:.1f}MB")
-                    os.remove(file_path)
-                    continue
-
-                logger.info(f"✅ LAST RESORT SUCCESS with {selector}: {file_path} ({file_size/1024/1024:.1f}MB)")
+            file_path = await download_youtube_format(video_info, base_params, selector, temp_folder)
+            if file_path:
+                logger.info("✅ LAST RESORT SUCCESS with %s: %s", selector, file_path)
+                _youtube_format_cache[format_cache_key] = selector
                 return file_path
 
         except Exception as e:
-            logger.warning(f"❌ Failed last resort selector {selector}: {str(e)}")
+            logger.warning("❌ Failed last resort selector %s: %s", selector, e)
 
     logger.error("❌ All YouTube Shorts download strategies failed")
     return None
 
+# Метаданные ffprobe по (путь, mtime_ns, размер): для неизменного файла результат не меняется
 async def get_video_metadata(video_path: str) -> tuple[int | None, int | None, int | None]:
     try:
+        stat = await asyncio.to_thread(os.stat, video_path)
+        cache_key = (video_path, stat.st_mtime_ns, stat.st_size)
+        cached = _video_metadata_cache.get(cache_key)
+        if cached:
+            logger.info("✅ Metadata from cache: %sx%s, %s sec.", *cached)
+            return cached
+
         logger.info("📋 Getting metadata from video file for 'smart' sending...")
-        ffprobe_command = [
-            'ffprobe', '-v', 'error', '-select_streams', 'v:0',
-            '-show_entries', 'stream=width,height,duration', '-of', 'json', video_path
-        ]
+        ffprobe_command = [*FFPROBE_VIDEO_ARGS, video_path]
         stdout, stderr = await run_subprocess(ffprobe_command, timeout=60)
-        video_info = json.loads(stdout)['streams'][0]
-        width = int(video_info.get('width', 0))
-        height = int(video_info.get('height', 0))
-        duration = int(float(video_info.get('duration', 0)))
-        logger.info(f"✅ Metadata obtained: {width}x{height}, {duration} sec.")
+        # Без обёрток ffprobe печатает только значения, по одному на строку: ширина, высота, длительность
+        width, height, duration, *_ = stdout.split()
+        width = int(width)
+        height = int(height)
+        duration = int(float(duration)) if duration != 'N/A' else 0
+        logger.info("✅ Metadata obtained: %sx%s, %s sec.", width, height, duration)
+        _video_metadata_cache.set(cache_key, (width, height, duration))
         return width, height, duration
     except Exception as e:
-        logger.warning(f"⚠️ Failed to get metadata from video file: {e}. Sending as usual.")
+        logger.warning("⚠️ Failed to get metadata from video file: %s. Sending as usual.", e)
         return None, None, None
 
+class StatusUpdater:
+    """Отложенное редактирование статус-сообщения. Промежуточный статус уходит в Telegram, только если
+    этап длится дольше STATUS_UPDATE_DELAY_SECONDS; более новый статус заменяет еще не отправленный.
+    Быстрые загрузки обходятся без лишних edit_text"""
+    def __init__(self, message, delay: float = STATUS_UPDATE_DELAY_SECONDS):
+        self.message = message
+        self.delay = delay
+        self._pending = None
+
+    def update(self, text: str):
+        """Планирует промежуточный статус (не ждет Telegram)"""
+        self.cancel()
+        self._pending = asyncio.create_task(self._edit_later(text))
+
+    async def _edit_later(self, text: str):
+        await asyncio.sleep(self.delay)
+        try:
+            await self.message.edit_text(text)
+        except TelegramError as e:
+            logger.warning("⚠️ Failed to update status message: %s", e)
+
+    def cancel(self):
+        """Отменяет еще не отправленный промежуточный статус"""
+        if self._pending and not self._pending.done():
+            self._pending.cancel()
+        self._pending = None
+
+    async def edit_now(self, text: str):
+        """Сразу показывает итоговый статус (ошибку или результат)"""
+        self.cancel()
+        await self.message.edit_text(text)
+
+async def delete_after_send(context: ContextTypes.DEFAULT_TYPE, chat_id: int, msg_id: int, status: StatusUpdater):
+    """После отправки видео удаляет исходное сообщение и статус-сообщение одновременно"""
+    status.cancel()
+    results = await asyncio.gather(
+        context.bot.delete_message(chat_id, msg_id),
+        status.message.delete(),
+        return_exceptions=True,
+    )
+    for what, result in zip(("original message", "status message"), results):
+        if isinstance(result, Exception):
+            logger.warning("⚠️ Failed to delete %s: %s", what, result)
+
 # --- ОСНОВНЫЕ ОБРАБОТЧИКИ ---
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.id in ALLOWED_GROUP_IDS:
@@ -1048,36 +1676,35 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def downloadmp3_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /downloadmp3"""
     if update.effective_chat.id in ALLOWED_GROUP_IDS:
+        report_debug_token = _report_debug.set({'ytdlp_stderr': '', 'video_send': ''})
         try:
-            await mp3_downloader.process_mp3_download(update, context)
+            # MP3 делит слоты загрузки чата с видеоссылками
+            async with chat_download_semaphore(context):
+                await mp3_downloader.process_mp3_download(update, context)
         except Exception as e:
-            logger.error(f"❌ Error processing MP3 download: {e}", exc_info=True)
+            logger.error("❌ Error processing MP3 download: %s", e, exc_info=True)
 
             # Отправляем детальную ошибку админу
-            user = update.effective_user
-            error_details = f"MP3 download error\n"
-            error_details += f"User: {user.username or user.first_name} (ID: {user.id})\n"
-            error_details += f"Chat ID: {update.effective_chat.id}\n"
-            error_details += f"Message ID: {update.message.message_id}\n"
-            error_details += f"Command args: {context.args if context.args else 'No args'}\n\n"
-            error_details += f"Exception: {str(e)}\n\n"
-            error_details += f"Traceback:\n{traceback.format_exc()}"
+            if admin_reports_enabled():
+                error_details = build_error_details(
+                    "MP3 download error",
+                    update.effective_user, update.effective_chat.id, update.message.message_id,
+                    f"Command args: {context.args if context.args else 'No args'}",
+                    exc=e,
+                )
 
-            await send_error_to_admin(
-                context,
-                f"MP3 Download: Непредвиденная ошибка - {str(e)}",
-                error_details,
-                "MP3 Download"
-            )
+                await send_error_to_admin(
+                    context,
+                    f"MP3 Download: Непредвиденная ошибка - {str(e)}",
+                    error_details,
+                    "MP3 Download"
+                )
+        finally:
+            _report_debug.reset(report_debug_token)
 
 async def process_instagram_link(update: Update, context: ContextTypes.DEFAULT_TYPE, url: str):
-    import traceback
-    import shutil
-    import os  # ✅ используем глобальный импорт, без переопределений
-
-    global _current_bot_context, _last_video_send_debug
-    _current_bot_context = context
-    _last_video_send_debug = ""
+    bot_context_token = _current_bot_context.set(context)
+    report_debug_token = _report_debug.set({'ytdlp_stderr': '', 'video_send': ''})
 
     chat_id, msg_id, user = update.effective_chat.id, update.message.message_id, update.effective_user
 
@@ -1086,35 +1713,36 @@ async def process_instagram_link(update: Update, context: ContextTypes.DEFAULT_T
         text="Проверяю содержимое Instagram поста... 🔍",
         reply_to_message_id=msg_id
     )
+    status = StatusUpdater(status_msg)
 
-    temp_folder = os.path.join(TEMP_DOWNLOADS_DIR, f"insta_{chat_id}_{msg_id}")
-    os.makedirs(temp_folder, exist_ok=True)
-    success = False
+    temp_folder = await temp_folder_pool.acquire()
 
     try:
-        await status_msg.edit_text("Обрабатываю Instagram пост... ⏳")
+        status.update("Обрабатываю Instagram пост... ⏳")
 
         video_path, photo_message = await download_video_with_yt_dlp_instagram(url, temp_folder)
 
         if photo_message:
             # Это пост только с фотографиями
-            await status_msg.edit_text(f"ℹ️ {photo_message}")
-            logger.info(f"ℹ️ Instagram post contains no video: {url}")
+            await status.edit_now(f"ℹ️ {photo_message}")
+            logger.info("ℹ️ Instagram post contains no video: %s", url)
             return
 
         if video_path:
             # 🔹 Проверяем размер файла ДО отправки
-            file_size = os.path.getsize(video_path)
+            file_size = await asyncio.to_thread(os.path.getsize, video_path)
             if file_size > 50 * 1024 * 1024:  # 50 MB
-                await status_msg.edit_text("⚠️ Сори, видео больше 50 МБ, а других форматов нет 😔")
-                logger.warning(f"Video too large to send: {file_size / (1024*1024):.2f} MB")
+                await status.edit_now("⚠️ Сори, видео больше 50 МБ, а других форматов нет 😔")
+                logger.warning("Video too large to send: %.2f MB", file_size / (1024*1024))
                 return  # Прерываем выполнение, не пытаемся отправить
 
             # 🔹 Получаем метаданные и отправляем видео
             caption = f"Instagram <a href=\"{url}\">видео</a> отправил {user.mention_html()}"
+            # Статус редактируется в фоне, пока работает ffprobe
+            status.update("Отправляю видео... 📤")
             width, height, duration = await get_video_metadata(video_path)
 
-            await send_video_with_retries(
+            sent_message = await send_video_with_retries(
                 context,
                 chat_id=chat_id,
                 video_path=video_path,
@@ -1129,21 +1757,17 @@ async def process_instagram_link(update: Update, context: ContextTypes.DEFAULT_T
                 user=user,
                 message_id=msg_id,
             )
-
-            await context.bot.delete_message(chat_id, msg_id)
-            success = True
+            remember_sent_video(url, sent_message)
+            await delete_after_send(context, chat_id, msg_id, status)
 
         else:
             # Если видео не удалось скачать
-            await status_msg.edit_text(
+            await status.edit_now(
                 "Не удалось скачать это видео. 😔\nВозможно, пост приватный, 18+ или аккаунты заблокированы."
             )
-            error_details = (
-                f"Instagram download failed for URL: {url}\n"
-                f"User: {user.username or user.first_name} (ID: {user.id})\n"
-                f"Chat ID: {chat_id}\n"
-                f"Message ID: {msg_id}\n"
-                "All cookie files failed to download the video."
+            error_details = build_error_details(
+                f"Instagram download failed for URL: {url}", user, chat_id, msg_id,
+                "All cookie files failed to download the video.",
             )
 
             await send_error_to_admin(
@@ -1154,74 +1778,70 @@ async def process_instagram_link(update: Update, context: ContextTypes.DEFAULT_T
             )
 
     except Exception as e:
-        logger.error(f"❌ Error processing Instagram: {e}", exc_info=True)
-        await status_msg.edit_text("Произошла непредвиденная ошибка. 😔")
+        logger.error("❌ Error processing Instagram: %s", e, exc_info=True)
+        await status.edit_now("Произошла непредвиденная ошибка. 😔")
 
         # Отправляем детальную ошибку админу
-        error_details = (
-            f"Instagram processing error for URL: {url}\n"
-            f"User: {user.username or user.first_name} (ID: {user.id})\n"
-            f"Chat ID: {chat_id}\n"
-            f"Message ID: {msg_id}\n\n"
-            f"Exception: {str(e)}\n\n"
-            f"Traceback:\n{traceback.format_exc()}"
-        )
+        if admin_reports_enabled():
+            error_details = build_error_details(
+                f"Instagram processing error for URL: {url}", user, chat_id, msg_id, exc=e
+            )
 
-        await send_error_to_admin(
-            context,
-            f"Instagram: Непредвиденная ошибка - {str(e)}",
-            error_details,
-            "Instagram"
-        )
+            await send_error_to_admin(
+                context,
+                f"Instagram: Непредвиденная ошибка - {str(e)}",
+                error_details,
+                "Instagram"
+            )
 
     finally:
-        _current_bot_context = None
-
-        if success:
-            try:
-                await status_msg.delete()
-            except Exception:
-                pass
+        _current_bot_context.reset(bot_context_token)
+        _report_debug.reset(report_debug_token)
+        status.cancel()
 
-        # 🔹 Безопасно удаляем временную папку
+        # 🔹 Безопасно очищаем временную папку и возвращаем ее в пул
         try:
-            if os.path.exists(temp_folder):
-                shutil.rmtree(temp_folder)
+            await temp_folder_pool.release(temp_folder)
         except Exception as cleanup_error:
-            logger.warning(f"Не удалось удалить временную папку {temp_folder}: {cleanup_error}")
+            logger.warning("Не удалось очистить временную папку %s: %s", temp_folder, cleanup_error)
 
 async def process_tiktok_link(update: Update, context: ContextTypes.DEFAULT_TYPE, url: str):
-    global _current_bot_context, _last_video_send_debug
-    _current_bot_context = context
-    _last_video_send_debug = ""
-
     chat_id, msg_id, user = update.effective_chat.id, update.message.message_id, update.effective_user
+    resolve_task = status = temp_folder = None
 
-    status_msg = await context.bot.send_message(
-        chat_id=chat_id,
-        text="Обрабатываю TikTok видео... ⏳",
-        reply_to_message_id=msg_id
-    )
+    # ContextVar ставятся непосредственно перед try, а задача, статус и папка создаются внутри него:
+    # ошибка отправки статуса не оставляет висящую задачу раскрытия ссылки и не сброшенные ContextVar
+    bot_context_token = _current_bot_context.set(context)
+    report_debug_token = _report_debug.set({'ytdlp_stderr': '', 'video_send': ''})
+    try:
+        # Короткая ссылка раскрывается, пока отправляется статус и выделяется временная папка
+        resolve_task = asyncio.create_task(resolve_tiktok_url(url))
 
-    temp_folder = os.path.join(TEMP_DOWNLOADS_DIR, f"tiktok_{chat_id}_{msg_id}")
-    os.makedirs(temp_folder, exist_ok=True)
-    success = False
+        status_msg = await context.bot.send_message(
+            chat_id=chat_id,
+            text="Обрабатываю TikTok видео... ⏳",
+            reply_to_message_id=msg_id
+        )
+        status = StatusUpdater(status_msg)
 
-    try:
-        resolved_url = resolve_tiktok_url(url)
+        temp_folder = await temp_folder_pool.acquire()
+
+        resolved_url = await resolve_task
         video_path, error_message = await download_video_with_yt_dlp_tiktok(resolved_url, temp_folder)
 
         if error_message:
             # Показываем пользователю конкретную ошибку
-            await status_msg.edit_text(f"ℹ️ {error_message}")
-            logger.info(f"ℹ️ TikTok specific error: {error_message}")
+            await status.edit_now(f"ℹ️ {error_message}")
+            logger.info("ℹ️ TikTok specific error: %s", error_message)
             return
 
         if video_path:
             caption = f"TikTok <a href=\"{url}\">видео</a> отправил {user.mention_html()}"
+            # Статус редактируется в фоне, пока работает ffprobe
+            status.update("Отправляю видео... 📤")
             width, height, duration = await get_video_metadata(video_path)
 
-            await send_video_with_retries(
+            sent_message = await send_video_with_retries(
                 context,
                 chat_id=chat_id,
                 video_path=video_path,
@@ -1236,19 +1856,17 @@ async def process_tiktok_link(update: Update, context: ContextTypes.DEFAULT_TYPE
                 user=user,
                 message_id=msg_id,
             )
-            await context.bot.delete_message(chat_id, msg_id)
-            success = True
+            remember_sent_video(url, sent_message)
+            await delete_after_send(context, chat_id, msg_id, status)
         else:
-            await status_msg.edit_text(
+            await status.edit_now(
                 "Не удалось скачать это видео. 😔\nВозможно, оно слишком большое или недоступно."
             )
             # Отправляем ошибку админу
-            error_details = f"TikTok download failed for URL: {url}\n"
-            error_details += f"Resolved URL: {resolved_url}\n"
-            error_details += f"User: {user.username or user.first_name} (ID: {user.id})\n"
-            error_details += f"Chat ID: {chat_id}\n"
-            error_details += f"Message ID: {msg_id}\n"
-            error_details += "Video download returned None - possibly too large or unavailable."
+            error_details = build_error_details(
+                f"TikTok download failed for URL: {url}\nResolved URL: {resolved_url}", user, chat_id, msg_id,
+                "Video download returned None - possibly too large or unavailable.",
+            )
 
             await send_error_to_admin(
                 context,
@@ -1257,50 +1875,51 @@ async def process_tiktok_link(update: Update, context: ContextTypes.DEFAULT_TYPE
                 "TikTok"
             )
     except Exception as e:
-        logger.error(f"❌ Error processing TikTok: {e}", exc_info=True)
-        await status_msg.edit_text("Произошла непредвиденная ошибка. Попробуйте еще раз через минуту!")
+        logger.error("❌ Error processing TikTok: %s", e, exc_info=True)
+        if status:
+            await status.edit_now("Произошла непредвиденная ошибка. Попробуйте еще раз через минуту!")
 
         # Отправляем детальную ошибку админу
-        error_details = f"TikTok processing error for URL: {url}\n"
-        error_details += f"User: {user.username or user.first_name} (ID: {user.id})\n"
-        error_details += f"Chat ID: {chat_id}\n"
-        error_details += f"Message ID: {msg_id}\n\n"
-        error_details += f"Exception: {str(e)}\n\n"
-        error_details += f"Traceback:\n{traceback.format_exc()}"
-
-        await send_error_to_admin(
-            context,
-            f"TikTok: Непредвиденная ошибка - {str(e)}",
-            error_details,
-            "TikTok"
-        )
+        if admin_reports_enabled():
+            error_details = build_error_details(
+                f"TikTok processing error for URL: {url}", user, chat_id, msg_id, exc=e
+            )
+
+            await send_error_to_admin(
+                context,
+                f"TikTok: Непредвиденная ошибка - {str(e)}",
+                error_details,
+                "TikTok"
+            )
     finally:
-        _current_bot_context = None
-        if success:
-            try: await status_msg.delete()
-            except Exception: pass
-        if os.path.exists(temp_folder):
-            shutil.rmtree(temp_folder)
+        _current_bot_context.reset(bot_context_token)
+        _report_debug.reset(report_debug_token)
+        if resolve_task:
+            resolve_task.cancel()
+        if status:
+            status.cancel()
+        if temp_folder:
+            await temp_folder_pool.release(temp_folder)
 
 async def process_youtube_shorts_link(update: Update, context: ContextTypes.DEFAULT_TYPE, url: str):
-    global _last_video_send_debug
-    _last_video_send_debug = ""
+    report_debug_token = _report_debug.set({'ytdlp_stderr': '', 'video_send': ''})
     chat_id, msg_id, user = update.effective_chat.id, update.message.message_id, update.effective_user
     status_msg = await context.bot.send_message(
         chat_id=chat_id,
         text="Обрабатываю YouTube Shorts видео... ⏳",
         reply_to_message_id=msg_id
     )
-    temp_folder = os.path.join(TEMP_DOWNLOADS_DIR, f"youtube_{chat_id}_{msg_id}")
-    os.makedirs(temp_folder, exist_ok=True)
-    success = False
+    status = StatusUpdater(status_msg)
+    temp_folder = await temp_folder_pool.acquire()
     try:
         video_path = await download_video_with_yt_dlp_youtube_shorts(url, temp_folder)
         if video_path:
             caption = f"YouTube Shorts <a href=\"{url}\">видео</a> отправил {user.mention_html()}"
+            # Статус редактируется в фоне, пока работает ffprobe
+            status.update("Отправляю видео... 📤")
             width, height, duration = await get_video_metadata(video_path)
 
-            await send_video_with_retries(
+            sent_message = await send_video_with_retries(
                 context,
                 chat_id=chat_id,
                 video_path=video_path,
@@ -1315,18 +1934,17 @@ async def process_youtube_shorts_link(update: Update, context: ContextTypes.DEFA
                 user=user,
                 message_id=msg_id,
             )
-            await context.bot.delete_message(chat_id, msg_id)
-            success = True
+            remember_sent_video(url, sent_message)
+            await delete_after_send(context, chat_id, msg_id, status)
         else:
-            await status_msg.edit_text(
+            await status.edit_now(
                 "Не удалось скачать это видео. 😔\nВозможно, видео недоступно."
             )
             # Отправляем ошибку админу
-            error_details = f"YouTube Shorts download failed for URL: {url}\n"
-            error_details += f"User: {user.username or user.first_name} (ID: {user.id})\n"
-            error_details += f"Chat ID: {chat_id}\n"
-            error_details += f"Message ID: {msg_id}\n"
-            error_details += "All quality-priority download attempts failed."
+            error_details = build_error_details(
+                f"YouTube Shorts download failed for URL: {url}", user, chat_id, msg_id,
+                "All quality-priority download attempts failed.",
+            )
 
             await send_error_to_admin(
                 context,
@@ -1335,47 +1953,64 @@ async def process_youtube_shorts_link(update: Update, context: ContextTypes.DEFA
                 "YouTube Shorts"
             )
     except Exception as e:
-        logger.error(f"❌ Error processing YouTube Shorts: {e}", exc_info=True)
-        await status_msg.edit_text("Произошла непредвиденная ошибка.")
+        logger.error("❌ Error processing YouTube Shorts: %s", e, exc_info=True)
+        await status.edit_now("Произошла непредвиденная ошибка.")
 
         # Отправляем детальную ошибку админу
-        error_details = f"YouTube Shorts processing error for URL: {url}\n"
-        error_details += f"User: {user.username or user.first_name} (ID: {user.id})\n"
-        error_details += f"Chat ID: {chat_id}\n"
-        error_details += f"Message ID: {msg_id}\n\n"
-        error_details += f"Exception: {str(e)}\n\n"
-        error_details += f"Traceback:\n{traceback.format_exc()}"
-
-        await send_error_to_admin(
-            context,
-            f"YouTube Shorts: Непредвиденная ошибка - {str(e)}",
-            error_details,
-            "YouTube Shorts"
-        )
+        if admin_reports_enabled():
+            error_details = build_error_details(
+                f"YouTube Shorts processing error for URL: {url}", user, chat_id, msg_id, exc=e
+            )
+
+            await send_error_to_admin(
+                context,
+                f"YouTube Shorts: Непредвиденная ошибка - {str(e)}",
+                error_details,
+                "YouTube Shorts"
+            )
     finally:
-        if success:
-            try: await status_msg.delete()
-            except Exception: pass
-        if os.path.exists(temp_folder):
-            shutil.rmtree(temp_folder)
+        _report_debug.reset(report_debug_token)
+        status.cancel()
+        await temp_folder_pool.release(temp_folder)
+
+def chat_download_semaphore(context: ContextTypes.DEFAULT_TYPE) -> asyncio.Semaphore:
+    """Семафор загрузок чата (CHAT_DOWNLOAD_CONCURRENCY), общий для ссылок и /downloadmp3"""
+    return context.chat_data.setdefault('download_semaphore', asyncio.Semaphore(CHAT_DOWNLOAD_CONCURRENCY))
+
+async def process_link_once(process_func, update: Update, context: ContextTypes.DEFAULT_TYPE, url: str, platform: str):
+    """Обрабатывает ссылку, если ее видео еще не отправлялось недавно; иначе пересылает его по file_id"""
+    # Один чат не должен занимать все слоты загрузки: его лишние ссылки ждут своей очереди.
+    # Слот чата берется до блокировки ссылки: иначе занятый чат, ожидая свой слот, держал бы блокировку
+    # и задерживал другие чаты, приславшие ту же ссылку
+    async with chat_download_semaphore(context), hold_url_lock(normalize_url(url)):
+        if await resend_cached_video(update, context, url, platform):
+            return
+        await process_func(update, context, url)
+
+# Имя группы MEDIA_URL_RE -> (обработчик, название платформы)
+LINK_HANDLERS = {
+    'instagram': (process_instagram_link, "Instagram"),
+    'tiktok': (process_tiktok_link, "TikTok"),
+    'youtube_shorts': (process_youtube_shorts_link, "YouTube Shorts"),
+}
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not (update.message and update.message.text and update.effective_chat.id in ALLOWED_GROUP_IDS): return
-    text = update.message.text
-    if insta_url := find_instagram_url(text):
-        await process_instagram_link(update, context, insta_url)
-    elif tiktok_url := find_tiktok_url(text):
-        await process_tiktok_link(update, context, tiktok_url)
-    elif youtube_shorts_url := find_youtube_shorts_url(text):
-        await process_youtube_shorts_link(update, context, youtube_shorts_url)
+    if found := find_media_url(update.message.text):
+        link_type, url = found
+        process_func, platform = LINK_HANDLERS[link_type]
+        await process_link_once(process_func, update, context, url, platform)
 
 async def setup_commands(application):
     """Настройка команд бота с описаниями"""
     commands = [
         ("downloadmp3", "Скачать MP3 из видео YouTube (использование: /downloadmp3 ссылка)")
     ]
-    await application.bot.set_my_commands(commands)
-    logger.info("✅ Bot commands configured successfully")
+    try:
+        await application.bot.set_my_commands(commands)
+        logger.info("✅ Bot commands configured successfully")
+    except Exception as e:
+        logger.warning("⚠️ Failed to configure bot commands: %s", e)
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик сетевых ошибок Telegram Bot API"""
@@ -1386,10 +2021,10 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
     elif isinstance(error, TimedOut):
         logger.warning("⏱️ Тайм-аут при обращении к Telegram API")
     elif isinstance(error, RetryAfter):
-        logger.warning(f"🚫 Превышен лимит запросов Telegram API. Повтор через {error.retry_after} сек")
+        logger.warning("🚫 Превышен лимит запросов Telegram API. Повтор через %s сек", error.retry_after)
     else:
         # Для всех остальных ошибок логируем кратко
-        logger.error(f"❌ Ошибка Telegram Bot API: {type(error).__name__}: {str(error)}")
+        logger.error("❌ Ошибка Telegram Bot API: %s: %s", type(error).__name__, error)
 
 def main():
     application = (
@@ -1399,18 +2034,43 @@ def main():
         .read_timeout(TELEGRAM_READ_TIMEOUT_SECONDS)
         .write_timeout(TELEGRAM_WRITE_TIMEOUT_SECONDS)
         .pool_timeout(TELEGRAM_POOL_TIMEOUT_SECONDS)
+        # Один keep-alive пул (HTTP/2 мультиплексирует запросы в одном TLS-соединении)
+        .connection_pool_size(TELEGRAM_CONNECTION_POOL_SIZE)
+        .http_version(TELEGRAM_HTTP_VERSION)
+        # Общий token bucket для всех запросов к Bot API (~30/сек всего) и отдельный на каждую группу
+        # (TELEGRAM_GROUP_MAX_RATE за TELEGRAM_GROUP_TIME_PERIOD_SECONDS). Если Telegram все же ответит RetryAfter,
+        # все запросы приостанавливаются на указанное время, а не продолжают получать отказы
+        .rate_limiter(AIORateLimiter(
+            group_max_rate=TELEGRAM_GROUP_MAX_RATE,
+            group_time_period=TELEGRAM_GROUP_TIME_PERIOD_SECONDS,
+            max_retries=TELEGRAM_RATE_LIMIT_RETRIES,
+        ))
         .build()
     )
     application.add_error_handler(error_handler)
     application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("downloadmp3", downloadmp3_command))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    # block=False: загрузка в одном чате не задерживает обработку сообщений из других чатов.
+    # Общая нагрузка ограничена пулом временных папок и семафорами yt-dlp/ffprobe, нагрузка чата - его семафором
+    application.add_handler(CommandHandler("downloadmp3", downloadmp3_command, block=False))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message, block=False))
     logger.info("🚀 Bot successfully started!")
 
     async def post_init(application):
-        await setup_commands(application)
+        global _http_client
+        _http_client = create_http_client()
+        # Не задерживаем запуск polling: команды настраиваются в фоне.
+        # Ссылку на задачу храним, чтобы ее не собрал GC и чтобы отменить при остановке
+        application.bot_data['setup_commands_task'] = asyncio.create_task(setup_commands(application))
+
+    async def post_shutdown(application):
+        task = application.bot_data.get('setup_commands_task')
+        if task and not task.done():
+            task.cancel()
+        if _http_client is not None:
+            await _http_client.aclose()
 
     application.post_init = post_init
+    application.post_shutdown = post_shutdown
     application.run_polling()
 
 if __name__ == "__main__":
@@ -1,162 +1,102 @@
 import logging
 import os
-import glob
 import asyncio
-import json
 import re
-from telegram import Update
+from telegram import InputFile, Update
+from telegram.error import TelegramError
 from telegram.ext import ContextTypes
-import shutil
 
 logger = logging.getLogger(__name__)
 
+# Постоянная часть параметров yt-dlp собирается один раз при загрузке модуля
+MP3_YTDLP_PARAMS = {
+    'format': 'bestaudio/best',
+    'postprocessors': [
+        # Извлечь только аудио в MP3, лучшее качество (0 = лучшее)
+        {'key': 'FFmpegExtractAudio', 'preferredcodec': 'mp3', 'preferredquality': '0'},
+        # Встроить метаданные
+        {'key': 'FFmpegMetadata', 'add_metadata': True},
+    ],
+    'no_warnings': True,
+    'playlist_items': '1',  # Только один элемент если это плейлист
+}
+YOUTUBE_HTTP_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36',
+    'Referer': 'https://www.youtube.com/',
+}
+
+# URL после команды: в двойных кавычках, в одинарных или без них
+COMMAND_URL_RE = re.compile(r"""/downloadmp3\s+(?:"([^"]+)"|'([^']+)'|(\S+))""")
+# Поддерживаемые ссылки: YouTube (обычные видео и Shorts)
+SUPPORTED_URL_RE = re.compile(r'youtube\.com/(?:watch\?v=|shorts/)|youtu\.be/')
+
 class MP3Downloader:
-    def __init__(self, temp_downloads_dir: str, telegram_size_limit: int):
-        self.temp_downloads_dir = temp_downloads_dir
+    def __init__(self, temp_folder_pool, telegram_size_limit: int, run_ytdlp):
+        # Пул переиспользуемых временных папок (acquire/release), общий с загрузкой видео
+        self.temp_folder_pool = temp_folder_pool
         self.telegram_size_limit = telegram_size_limit
+        # Запуск yt-dlp как библиотеки (с общим ограничением параллельных загрузок):
+        # async (source, params, download, timeout) -> (info, stderr)
+        self.run_ytdlp = run_ytdlp
 
     def extract_url_from_command(self, text: str) -> str | None:
         """Извлекает URL из команды /downloadmp3"""
-        # Ищем URL в кавычках или без них после команды
-        patterns = [
-            r'/downloadmp3\s+"([^"]+)"',  # URL в двойных кавычках
-            r"/downloadmp3\s+'([^']+)'",  # URL в одинарных кавычках
-            r'/downloadmp3\s+(\S+)',      # URL без кавычек
-        ]
-
-        for pattern in patterns:
-            match = re.search(pattern, text)
-            if match:
-                return match.group(1)
-        return None
+        match = COMMAND_URL_RE.search(text)
+        if not match:
+            return None
+        return next(filter(None, match.groups()), None)
 
     def is_supported_url(self, url: str) -> bool:
         """Проверяет, поддерживается ли URL для скачивания MP3"""
-        supported_patterns = [
-            r'youtube\.com/watch\?v=',
-            r'youtube\.com/shorts/',
-            r'youtu\.be/',
-        ]
-
-        return any(re.search(pattern, url) for pattern in supported_patterns)
-
-    async def run_subprocess(self, command: list[str], timeout: int = 180) -> tuple[str, str]:
-        """Выполняет команду в подпроцессе"""
-        logger.info(f"🛠 Running MP3 command: {' '.join(command)}")
-
-        process = await asyncio.create_subprocess_exec(
-            *command,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-
-        try:
-            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=timeout)
-
-            if stdout:
-                logger.info(f"[yt-dlp MP3 STDOUT]\n{stdout.decode(errors='ignore')}")
-            if stderr:
-                logger.warning(f"[yt-dlp MP3 STDERR]\n{stderr.decode(errors='ignore')}")
-
-            return stdout.decode(), stderr.decode()
+        return bool(SUPPORTED_URL_RE.search(url))
 
-        except asyncio.TimeoutError:
-            try:
-                process.kill()
-                raise TimeoutError(f"MP3 command timed out after {timeout} seconds")
-            except ProcessLookupError:
-                pass
-            raise
-
-    async def get_audio_info(self, url: str) -> dict | None:
-        """Получает информацию об аудио для выбора лучшего качества"""
+    async def download_mp3(self, url: str, temp_folder: str) -> tuple[str, dict] | None:
+        """Скачивает MP3 в лучшем качестве. Возвращает (путь, метаданные) - длительность из info yt-dlp,
+        размер из stat файла, без отдельного запуска ffprobe"""
         try:
-            command = ['yt-dlp', '--dump-json', '--no-warnings', url]
-            stdout, stderr = await self.run_subprocess(command, timeout=60)
-
-            if not stdout.strip():
-                return None
+            logger.info("🎵 Starting MP3 download: %s", url)
 
-            info = json.loads(stdout)
-            return info
-
-        except Exception as e:
-            logger.error(f"❌ Failed to get audio info: {e}")
-            return None
-
-    async def download_mp3(self, url: str, temp_folder: str) -> str | None:
-        """Скачивает MP3 в лучшем качестве"""
-        try:
-            logger.info(f"🎵 Starting MP3 download: {url}")
-
-            # Команда для скачивания лучшего аудио и конвертации в MP3
-            # yt-dlp сам выберет лучшее аудио и сконвертирует в MP3
-            command = [
-                'yt-dlp',
-                url,
-                '--extract-audio',              # Извлечь только аудио
-                '--audio-format', 'mp3',        # Конвертировать в MP3
-                '--audio-quality', '0',         # Лучшее качество (0 = лучшее)
-                '--embed-metadata',             # Встроить метаданные
-                '--add-metadata',               # Добавить метаданные
-                '-o', os.path.join(temp_folder, '%(title)s.%(ext)s'),
-                '--no-warnings',
-                '--playlist-items', '1',        # Только один элемент если это плейлист
-            ]
+            # Скачивание лучшего аудио и конвертация в MP3: yt-dlp сам выберет лучшее аудио
+            params = {**MP3_YTDLP_PARAMS, 'outtmpl': os.path.join(temp_folder, '%(title)s.%(ext)s')}
 
             # Для YouTube добавляем дополнительные заголовки
             if 'youtube.com' in url or 'youtu.be' in url:
-                command.extend([
-                    '--add-header', 'User-Agent: Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36',
-                    '--add-header', 'Referer: https://www.youtube.com/',
-                ])
-
-            await self.run_subprocess(command)
+                params['http_headers'] = YOUTUBE_HTTP_HEADERS
 
-            # Ищем скачанный MP3 файл
-            mp3_files = glob.glob(os.path.join(temp_folder, '*.mp3'))
+            info, _ = await self.run_ytdlp(url, params, download=True, timeout=180)
 
-            if not mp3_files:
+            # Путь к MP3 берем из info этой загрузки (после FFmpegExtractAudio), а не ищем файл в папке:
+            # в папке пула может оказаться чужой файл
+            downloads = (info or {}).get('requested_downloads') or []
+            mp3_path = downloads[-1].get('filepath') if downloads else None
+            if not mp3_path or not mp3_path.endswith('.mp3'):
                 raise Exception("MP3 file was not created")
 
-            mp3_path = mp3_files[0]
-
             # Проверяем размер файла
-            file_size = os.path.getsize(mp3_path)
+            file_size = (await asyncio.to_thread(os.stat, mp3_path)).st_size
             if file_size > self.telegram_size_limit:
-                logger.warning(f"⚠️ MP3 file too large: {file_size / (1024*1024):.1f} MB")
+                logger.warning("⚠️ MP3 file too large: %.1f MB", file_size / (1024*1024))
                 return None
 
-            logger.info(f"✅ MP3 successfully downloaded: {mp3_path} ({file_size / (1024*1024):.1f} MB)")
-            return mp3_path
+            logger.info("✅ MP3 successfully downloaded: %s (%.1f MB)", mp3_path, file_size / (1024*1024))
+            duration = downloads[-1].get('duration') or info.get('duration')
+            metadata = {
+                'duration': int(duration) if duration else None,
+                'size_mb': round(file_size / (1024*1024), 1),
+            }
+            return mp3_path, metadata
 
         except Exception as e:
-            logger.error(f"❌ MP3 download failed: {e}")
+            logger.error("❌ MP3 download failed: %s", e)
             return None
 
-    async def get_audio_metadata(self, audio_path: str) -> dict:
-        """Получает метаданные аудиофайла"""
+    @staticmethod
+    async def edit_status(status_msg, text: str):
+        """Промежуточный статус: его ошибка не должна прерывать загрузку"""
         try:
-            command = [
-                'ffprobe', '-v', 'error',
-                '-show_entries', 'format=duration,size:stream=codec_name',
-                '-of', 'json', audio_path
-            ]
-
-            stdout, stderr = await self.run_subprocess(command, timeout=30)
-            info = json.loads(stdout)
-
-            duration = float(info.get('format', {}).get('duration', 0))
-            size = int(info.get('format', {}).get('size', 0))
-
-            return {
-                'duration': int(duration),
-                'size_mb': round(size / (1024*1024), 1)
-            }
-
-        except Exception as e:
-            logger.warning(f"⚠️ Failed to get audio metadata: {e}")
-            return {'duration': None, 'size_mb': None}
+            await status_msg.edit_text(text)
+        except TelegramError as e:
+            logger.warning("⚠️ Failed to update status message: %s", e)
 
     async def process_mp3_download(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Основная функция обработки команды /downloadmp3"""
@@ -168,12 +108,12 @@ class MP3Downloader:
         user = update.effective_user
         text = update.message.text
 
-        logger.info(f"📥 MP3 download request from user {user.id} ({user.username or user.first_name}) in chat {chat_id}")
+        logger.info("📥 MP3 download request from user %s (%s) in chat %s", user.id, user.username or user.first_name, chat_id)
 
         # Извлекаем URL из команды
         url = self.extract_url_from_command(text)
         if not url:
-            logger.warning(f"❌ Invalid command format from user {user.id}: {text}")
+            logger.warning("❌ Invalid command format from user %s: %s", user.id, text)
             await update.message.reply_text(
                 "❌ Неверный формат команды!\n\n"
                 "Используйте:\n"
@@ -186,7 +126,7 @@ class MP3Downloader:
 
         # Проверяем поддерживаемость URL
         if not self.is_supported_url(url):
-            logger.warning(f"❌ Unsupported URL from user {user.id}: {url}")
+            logger.warning("❌ Unsupported URL from user %s: %s", user.id, url)
             await update.message.reply_text(
                 "❌ Данный тип ссылки не поддерживается!\n\n"
                 "Поддерживаются:\n"
@@ -194,7 +134,7 @@ class MP3Downloader:
             )
             return
 
-        logger.info(f"🎯 Processing MP3 download for URL: {url}")
+        logger.info("🎯 Processing MP3 download for URL: %s", url)
 
         # Отправляем статус сообщение
         status_msg = await context.bot.send_message(
@@ -203,19 +143,18 @@ class MP3Downloader:
             reply_to_message_id=msg_id
         )
 
-        temp_folder = os.path.join(self.temp_downloads_dir, f"mp3_{chat_id}_{msg_id}")
-        os.makedirs(temp_folder, exist_ok=True)
+        temp_folder = await self.temp_folder_pool.acquire()
         success = False
 
         try:
-            # Обновляем статус
-            await status_msg.edit_text(f"🎵 Скачиваю аудио в лучшем качестве...\n🔗 {url}")
-
-            # Скачиваем MP3
-            mp3_path = await self.download_mp3(url, temp_folder)
+            # Скачиваем MP3, одновременно обновляя статус
+            _, downloaded = await asyncio.gather(
+                self.edit_status(status_msg, f"🎵 Скачиваю аудио в лучшем качестве...\n🔗 {url}"),
+                self.download_mp3(url, temp_folder),
+            )
 
-            if not mp3_path:
-                logger.error(f"❌ MP3 download failed for URL: {url}")
+            if not downloaded:
+                logger.error("❌ MP3 download failed for URL: %s", url)
                 await status_msg.edit_text(
                     "❌ Не удалось скачать аудио.\n"
                     "Возможные причины:\n"
@@ -225,8 +164,8 @@ class MP3Downloader:
                 )
                 return
 
-            # Получаем метаданные
-            metadata = await self.get_audio_metadata(mp3_path)
+            mp3_path, metadata = downloaded
+            await self.edit_status(status_msg, "📤 Отправляю MP3 файл...")
 
             # Формируем описание
             file_name = os.path.basename(mp3_path)
@@ -238,14 +177,13 @@ class MP3Downloader:
                 caption += f"\n📁 Размер: {metadata['size_mb']} MB"
 
             # Отправляем файл
-            await status_msg.edit_text("📤 Отправляю MP3 файл...")
-
-            logger.info(f"📤 Sending MP3 file: {file_name} ({metadata['size_mb']} MB)")
+            logger.info("📤 Sending MP3 file: %s (%s MB)", file_name, metadata['size_mb'])
 
-            with open(mp3_path, 'rb') as audio_file:
+            # read_file_handle=False: файл отправляется с диска частями, а не читается целиком в event loop
+            with await asyncio.to_thread(open, mp3_path, 'rb') as audio_file:
                 await context.bot.send_audio(
                     chat_id=chat_id,
-                    audio=audio_file,
+                    audio=InputFile(audio_file, filename=file_name, read_file_handle=False),
                     caption=caption,
                     parse_mode="HTML",
                     duration=metadata['duration'],
@@ -254,10 +192,10 @@ class MP3Downloader:
 
             success = True
             await context.bot.delete_message(chat_id, msg_id)
-            logger.info(f"✅ MP3 successfully sent to user {user.id} in chat {chat_id}")
+            logger.info("✅ MP3 successfully sent to user %s in chat %s", user.id, chat_id)
 
         except Exception as e:
-            logger.error(f"❌ Error processing MP3 request from user {user.id}: {e}", exc_info=True)
+            logger.error("❌ Error processing MP3 request from user %s: %s", user.id, e, exc_info=True)
             await status_msg.edit_text(
                 "❌ Произошла ошибка при обработке запроса.\n"
                 "Попробуйте еще раз через несколько минут."
@@ -269,9 +207,8 @@ class MP3Downloader:
                 try:
                     await status_msg.delete()
                 except Exception as e:
-                    logger.warning(f"⚠️ Failed to delete status message: {e}")
+                    logger.warning("⚠️ Failed to delete status message: %s", e)
 
-            # Очищаем временную папку
-            if os.path.exists(temp_folder):
-                shutil.rmtree(temp_folder)
-                logger.info(f"🧹 Cleaned up temp folder: {temp_folder}")
+            # Очищаем временную папку и возвращаем ее в пул
+            await self.temp_folder_pool.release(temp_folder)
+            logger.debug("🧹 Cleaned up temp folder: %s", temp_folder)